@@ -0,0 +1,60 @@
+import numpy as np
+from pytest import fixture
+
+from wfc_headless import TILE_SOLIDITY
+from wfc_model import compass, overlap, train_on_array
+
+# hardly any tile pairs are allowed here, so greedy collapse mostly fails
+TANGLED = np.array([[2, 1, 1, 3], [4, 5, 2, 4], [5, 2, 3, 1], [5, 4, 4, 3]])
+
+
+@fixture
+def tangled():
+    return train_on_array(TANGLED)
+
+
+def _consistent(model, tiles):
+    indexes = np.vectorize(model.index.get)(tiles)
+    for d, (_, (deltax, deltay)) in enumerate(compass):
+        here, there = overlap(deltax, deltay, *tiles.shape)
+        if not model.compatible[d, indexes[here], indexes[there]].all():
+            return False
+    return True
+
+
+@fixture
+def consistent():
+    # every pair of neighbouring tiles is one the model allows
+    return _consistent
+
+
+def _passable_regions(tiles):
+    # 4-connected regions of passable tiles, by flood fill
+    passable = [[not TILE_SOLIDITY[each] for each in row] for row in tiles.tolist()]
+    h, w = tiles.shape
+    region = np.full((h, w), -1)
+    count = 0
+    for y in range(h):
+        for x in range(w):
+            if passable[y][x] and region[y, x] < 0:
+                region[y, x] = count
+                queue = [(x, y)]
+                while queue:
+                    cellx, celly = queue.pop()
+                    for _, (deltax, deltay) in compass:
+                        otherx, othery = cellx + deltax, celly + deltay
+                        if (
+                            0 <= otherx < w
+                            and 0 <= othery < h
+                            and passable[othery][otherx]
+                            and region[othery, otherx] < 0
+                        ):
+                            region[othery, otherx] = count
+                            queue.append((otherx, othery))
+                count += 1
+    return region, count
+
+
+@fixture
+def passable_regions():
+    return _passable_regions
@@ -0,0 +1,17 @@
+import json
+
+from wfc_bench import report, run
+
+
+def test_quick_run_reports_every_hot_path():
+    results = run(quick=True)
+    names = {each.name for each in results}
+    assert {"train_on_array", "train_on_map", "solve", "select"} <= names
+    assert any(name.startswith("render_") for name in names)
+    (solve,) = [each for each in results if each.name == "solve"]
+    assert solve.size == (20, 20)
+    assert solve.metrics["collapses_per_second"] > 0
+    assert 0 <= solve.metrics["contradiction_rate"] <= 1
+    assert all(each.seconds > 0 and each.peak_bytes >= 0 for each in results)
+    saved = json.loads(json.dumps(report(results)))
+    assert len(saved["results"]) == len(results)
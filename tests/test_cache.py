@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+
+from wfc_cache import ResultCache, cached_model, evict, result_key
+from wfc_headless import TILE_SOLIDITY
+from wfc_model import Connectivity, Stats, load_tile_map, train_on_array
+
+
+def test_cached_model_round_trip(tmp_path):
+    source = tmp_path / "map.txt"
+    source.write_text("01 02 01\n03 03 03\n")
+    first = cached_model(str(source), cache_dir=tmp_path / "models")
+    (entry,) = (tmp_path / "models").glob("*.npz")
+    second = cached_model(str(source), cache_dir=tmp_path / "models")
+    assert second.tile_ids == first.tile_ids == (1, 2, 3)
+    assert np.array_equal(second.counts, first.counts)
+    assert np.array_equal(
+        first.counts, train_on_array(np.array([[1, 2, 1], [3, 3, 3]])).counts
+    )
+
+    # a different map is a different entry
+    source.write_text("01 01\n01 01\n")
+    assert cached_model(str(source), cache_dir=tmp_path / "models").tile_ids == (1,)
+    assert len(list((tmp_path / "models").glob("*.npz"))) == 2
+    assert entry.exists()
+
+
+def test_cached_model_retrains_over_a_broken_entry(tmp_path):
+    source = tmp_path / "map.txt"
+    source.write_text("01 02 01\n03 03 03\n")
+    first = cached_model(str(source), cache_dir=tmp_path / "models")
+    (entry,) = (tmp_path / "models").glob("*.npz")
+    data = entry.read_bytes()
+    for broken in (data[: len(data) // 2], b""):
+        entry.write_bytes(broken)
+        again = cached_model(str(source), cache_dir=tmp_path / "models")
+        assert np.array_equal(again.counts, first.counts)
+        assert entry.read_bytes() == data
+
+
+def test_evict_least_recently_used(tmp_path):
+    for age, name in enumerate(["old", "middle", "new"]):
+        entry = tmp_path / f"{name}.npz"
+        entry.write_bytes(b"x" * 10)
+        os.utime(entry, (age, age))
+    evict(tmp_path, 20)
+    assert sorted(each.stem for each in tmp_path.glob("*.npz")) == ["middle", "new"]
+
+
+def test_result_cache_reuses_solved_maps(tmp_path):
+    model = train_on_array(np.array([[1, 2, 1, 2], [3, 3, 3, 3], [1, 2, 1, 2]]))
+    cache = ResultCache(max_entries=1, cache_dir=tmp_path)
+    first = cache.generate(model, 5, 6, seed=7)
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert np.array_equal(cache.generate(model, 5, 6, seed=7), first)
+    assert cache.hits == 1
+    assert not first.flags.writeable
+
+    # only the latest map stays in memory, the disk keeps both
+    cache.generate(model, 5, 6, seed=8)
+    assert len(cache.entries) == 1 and len(list(tmp_path.glob("*.npy"))) == 2
+    fresh = ResultCache(cache_dir=tmp_path)
+    assert np.array_equal(fresh.generate(model, 5, 6, seed=7), first)
+    assert (fresh.hits, fresh.misses) == (1, 0)
+
+    # a broken entry is a miss, and gets solved and written again
+    (entry,) = [
+        each
+        for each in tmp_path.glob("*.npy")
+        if each.stem == result_key(model, 5, 6, 7)
+    ]
+    for broken in (b"", entry.read_bytes()[:20]):
+        entry.write_bytes(broken)
+        fresh = ResultCache(cache_dir=tmp_path)
+        assert np.array_equal(fresh.generate(model, 5, 6, seed=7), first)
+        assert (fresh.hits, fresh.misses) == (0, 1)
+
+    fixed = np.full((5, 6), -1)
+    fixed[0, 0] = 3
+    assert result_key(model, 5, 6, 7, fixed) != result_key(model, 5, 6, 7)
+    assert result_key(model, 5, 6, 7, options={"max_restarts": 0}) != result_key(
+        model, 5, 6, 7
+    )
+
+
+def test_result_cache_passes_on_options_it_does_not_key_on():
+    model = train_on_array(load_tile_map())
+    cache = ResultCache()
+    stats = Stats()
+    first = cache.generate(model, 8, 8, seed=1, stats=stats, should_stop=lambda: False)
+    assert stats.counts["decisions"]
+    assert np.array_equal(cache.generate(model, 8, 8, seed=1), first)
+    assert cache.hits == 1
+
+    connectivity = Connectivity.from_solidity(model, TILE_SOLIDITY, everything=True)
+    joined = cache.generate(model, 8, 8, seed=1, connectivity=connectivity)
+    assert cache.misses == 2
+    again = Connectivity.from_solidity(model, TILE_SOLIDITY, everything=True)
+    assert np.array_equal(
+        cache.generate(model, 8, 8, seed=1, connectivity=again), joined
+    )
+    assert cache.hits == 2
+    required = Connectivity.from_solidity(model, TILE_SOLIDITY, required=[(0, 0)])
+    assert result_key(model, 8, 8, 1, options={"connectivity": required}) != (
+        result_key(model, 8, 8, 1, options={"connectivity": connectivity})
+    )
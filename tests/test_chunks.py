@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from wfc_chunks import WorldFile, export_hex, import_hex, write_world
+from wfc_model import Direction, load_tile_map, train_on_array
+from wfc_outpaint import screen_h, screen_w
+
+
+def test_hex_round_trips_through_a_world_file(tmp_path):
+    import_hex("data/zelda_overworld_map.txt", tmp_path / "overworld.wfcw")
+    world = WorldFile.open(tmp_path / "overworld.wfcw")
+    assert len(world) == 16 * 8
+    assert world.dtype == np.uint8
+    overworld = load_tile_map()
+    assert np.array_equal(world[(3, 2)], overworld[22:33, 48:64])
+    export_hex(tmp_path / "overworld.wfcw", tmp_path / "overworld.txt")
+    with open("data/zelda_overworld_map.txt", "rb") as original:
+        assert (tmp_path / "overworld.txt").read_bytes() == original.read()
+
+
+def test_world_file_keeps_wide_ids_and_sparse_chunks(tmp_path):
+    chunks = {
+        (-1, 4): np.full((screen_h, screen_w), 300),
+        (2, 0): np.arange(screen_h * screen_w).reshape(screen_h, screen_w),
+    }
+    write_world(tmp_path / "sparse.wfcw", chunks)
+    world = WorldFile.open(tmp_path / "sparse.wfcw")
+    assert world.dtype == np.uint16
+    assert set(world) == set(chunks)
+    for chunk, tiles in chunks.items():
+        assert np.array_equal(world[chunk], tiles)
+    assert (-1, 0) not in world
+    with pytest.raises(ValueError):
+        world.tiles()
+    with pytest.raises(ValueError):
+        write_world(tmp_path / "bad.wfcw", {(0, 0): np.full((screen_h, 3), 1)})
+
+
+def test_world_file_loads_into_a_world_that_extends(tmp_path):
+    import_hex("data/zelda_overworld_map.txt", tmp_path / "overworld.wfcw")
+    overworld = load_tile_map()
+    world = WorldFile.open(tmp_path / "overworld.wfcw").world(
+        train_on_array(overworld), seed=1
+    )
+    assert np.array_equal(world.region(0, 0, 256, 88), overworld)
+    world.extend(Direction.south)
+    write_world(tmp_path / "bigger.wfcw", world.chunks)
+    bigger = WorldFile.open(tmp_path / "bigger.wfcw")
+    assert bigger.tiles().shape == (99, 256)
@@ -0,0 +1,31 @@
+import numpy as np
+
+from wfc_headless import compose, export_batch, read_png, tile_atlas, write_png
+
+
+def test_png_round_trip(tmp_path):
+    pixels = np.random.default_rng(0).integers(0, 256, (5, 7, 3), dtype=np.uint8)
+    write_png(tmp_path / "noise.png", pixels)
+    assert np.array_equal(read_png(tmp_path / "noise.png"), pixels)
+
+
+def test_atlas_matches_exported_tiles():
+    atlas = tile_atlas()
+    assert atlas.shape == (160, 16, 16, 3)
+    for i in range(160):
+        single = read_png(f"data/tiles/overworld_tile_{i}.png")
+        assert np.array_equal(atlas[i], single[:, :, :3])
+    assert tile_atlas(30).shape == (160, 30, 30, 3)
+
+
+def test_compose_and_export(tmp_path):
+    atlas = tile_atlas(4)
+    grid = np.array([[1, 2, 3], [4, 5, 6]])
+    pixels = compose(grid, atlas)
+    assert pixels.shape == (8, 12, 3)
+    assert np.array_equal(pixels[4:8, 8:12], atlas[6])
+    paths = export_batch([grid, grid.T], tmp_path, atlas)
+    assert [path.name for path in paths] == ["map_0.png", "map_1.png"]
+    assert np.array_equal(read_png(paths[1]), compose(grid.T, atlas))
+    (raw,) = export_batch([grid], tmp_path / "raw", atlas, suffix=".rgb")
+    assert raw.read_bytes() == pixels.tobytes()
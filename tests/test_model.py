@@ -0,0 +1,295 @@
+from random import Random
+
+import numpy as np
+import pytest
+
+from wfc_headless import TILE_SOLIDITY
+from wfc_model import (
+    Backtracked,
+    Collapsed,
+    Connectivity,
+    Contradiction,
+    Direction,
+    DomainChanged,
+    GeneratingTile,
+    Propagator,
+    Restarted,
+    Scheduler,
+    Stats,
+    Solver,
+    TileId,
+    Wave,
+    compile_trained,
+    compress,
+    generate,
+    load_tile_map,
+    pruned,
+    train_on_array,
+    train_on_map,
+)
+
+STRIPES = [
+    [TileId(1), TileId(2), TileId(1), TileId(2), TileId(1)],
+    [TileId(3), TileId(3), TileId(3), TileId(3), TileId(3)],
+    [TileId(1), TileId(2), TileId(1), TileId(2), TileId(1)],
+]
+
+
+def test_train_on_non_square_map():
+    trained = train_on_map(STRIPES)
+    assert set(trained) == {1, 2, 3}
+    assert set(trained[TileId(1)].possibilities[Direction.east]) == {2}
+    assert set(trained[TileId(1)].possibilities[Direction.north]) == {3}
+
+
+def test_observe_restricts_neighbors():
+    model = compile_trained(train_on_map(STRIPES))
+    wave = Wave.empty(model, 3, 4)
+    assert Propagator(wave).observe(Random(0), 1, 1) == 3
+    assert wave.remaining(1, 0) == [1, 2]
+    assert wave.remaining(1, 2) == [1, 2]
+    assert wave.remaining(0, 1) == [3]
+    assert wave.remaining(2, 1) == [3]
+    tiles = wave.tiles()
+    assert tiles[1].tolist() == [3, 3, 3, 3]
+    assert (tiles == -1).sum() == 8
+    # tile 3 never sits directly above or below itself
+    three = model.tile_ids.index(TileId(3))
+    assert not model.compatible[0, three, three]
+    assert model.compatible[1, three, three]
+
+
+def test_propagation_reaches_fixpoint():
+    model = compile_trained(train_on_map(STRIPES))
+    wave = Wave.empty(model, 3, 5)
+    propagator = Propagator(wave)
+    propagator.collapse(0, 0, model.tile_ids.index(TileId(1)))
+    # a single corner forces its whole stripe and the row of 3s below it
+    assert wave.tiles().tolist()[:2] == STRIPES[:2]
+    assert wave.remaining(0, 2) == [1, 2]
+
+
+def test_propagation_contradiction():
+    model = compile_trained(train_on_map(STRIPES))
+    propagator = Propagator(Wave.empty(model, 3, 5))
+    propagator.collapse(0, 0, model.tile_ids.index(TileId(1)))
+    try:
+        propagator.collapse(1, 0, model.tile_ids.index(TileId(1)))
+    except Contradiction:
+        pass
+    else:
+        assert False, "1 next to 1 should not be allowed"
+
+
+def test_scheduler_picks_lowest_entropy():
+    model = compile_trained(train_on_map(STRIPES))
+    wave = Wave.empty(model, 3, 5)
+    propagator = Propagator(wave)
+    propagator.scheduler = scheduler = Scheduler(wave, Random(0))
+    # only 1 and 2 are left on the bottom row, the others still allow 1, 2 and 3
+    wave.possible[2, :, model.tile_ids.index(TileId(3))] = False
+    for x in range(5):
+        scheduler.touch(x, 2)
+    assert scheduler.pick()[1] == 2
+
+
+def test_generate_fills_every_cell():
+    model = compile_trained(train_on_map(STRIPES))
+    tiles = generate(model, 6, 7, Random(1))
+    assert (tiles != -1).all()
+
+
+def test_entropy_sums_follow_bans():
+    model = compile_trained(train_on_map(STRIPES))
+    wave = Wave.empty(model, 3, 5)
+    propagator = Propagator(wave)
+    propagator.collapse(2, 1, model.tile_ids.index(TileId(3)))
+    running = wave.entropies()
+    wave.recount()
+    assert np.allclose(running, wave.entropies(), equal_nan=True)
+    assert wave.counts[1].tolist() == [1] * 5
+    assert wave.entropy(0, 0) > 0
+
+
+def test_compiled_set_is_dense_and_read_only():
+    model = compile_trained(train_on_map(STRIPES))
+    one, two, three = (model.index[TileId(each)] for each in (1, 2, 3))
+    assert model.counts.shape == (4, 3, 3)
+    # 1 sits east of 2 twice in both striped rows
+    assert model.counts[1, two, one] == 4
+    assert np.isclose(model.weights.sum(), 1)
+    assert not model.counts.flags.writeable
+    assert not model.compatible[0, three, three]
+
+
+def test_generating_tile_uses_compiled_set():
+    model = compile_trained(train_on_map(STRIPES))
+    in_progress = [[GeneratingTile() for y in range(3)] for x in range(4)]
+    in_progress[1][0].remaining = {TileId(2)}
+    in_progress[0][1].remaining = {TileId(3)}
+    in_progress[0][0].observe(Random(0), 0, 0, 3, 4, in_progress, model)
+    assert in_progress[0][0].remaining == {1}
+    assert in_progress[1][0].remaining == {2}
+    assert in_progress[0][1].remaining == {3}
+
+
+def test_train_on_array_matches_train_on_map():
+    overworld = load_tile_map()
+    assert overworld.shape == (88, 256)
+    slow = compile_trained(train_on_map(overworld.tolist()))
+    fast = train_on_array(overworld)
+    assert fast.tile_ids == slow.tile_ids
+    assert np.array_equal(fast.counts, slow.counts)
+    assert np.allclose(fast.weights, slow.weights)
+
+
+def test_pruned_drops_edge_tiles_and_what_only_they_supported():
+    # 5 is only seen on the top edge and 7 only ever below a 5
+    model = train_on_array(np.array([[1, 5, 1, 1], [1, 7, 1, 1], [1, 1, 1, 1]]))
+    assert model.tile_ids == (1, 5, 7)
+    small = pruned(model)
+    assert small.tile_ids == (1,)
+    assert np.array_equal(small.counts, model.counts[:, :1, :1])
+    assert (Solver(small, 4, 4, Random(0)).solve() == 1).all()
+    assert pruned(small) is small
+    assert train_on_array(load_tile_map(), prune=True).tile_ids == (
+        train_on_array(load_tile_map()).tile_ids
+    )
+
+
+def test_compress_solves_over_classes_and_expands_back(consistent):
+    # 1 and 4 are interchangeable everywhere, as are 2 and 5
+    row = [1, 2, 4, 5, 1, 5, 4, 2, 1]
+    model = train_on_array(np.array([row, [3] * 9, row, [3] * 9]))
+    classes = compress(model)
+    assert classes.compressed.tile_ids == (1, 2, 3)
+    assert classes.compressed.counts.sum() == model.counts.sum()
+    assert np.allclose(classes.compressed.weights.sum(), 1)
+    constraints = np.full((6, 6), -1)
+    constraints[1, 1] = 4
+    tiles = classes.generate(6, 6, Random(0), constraints)
+    assert tiles[1, 1] == 4
+    assert {1, 4} <= set(tiles.ravel().tolist())
+    assert consistent(model, tiles)
+    assert np.array_equal(tiles, classes.generate(6, 6, Random(0), constraints))
+
+
+def test_solver_backtracks_out_of_contradictions(tangled, consistent):
+    model = tangled
+    greedy_failures = 0
+    for seed in range(5):
+        try:
+            Solver(model, 8, 8, Random(seed), max_backtracks=0, max_restarts=0).solve()
+        except Contradiction:
+            greedy_failures += 1
+        solver = Solver(model, 8, 8, Random(seed), max_restarts=0)
+        assert consistent(model, solver.solve())
+    assert greedy_failures
+    assert solver.backtracks
+
+
+def test_restart_raises_the_error_once_out_of_restarts(tangled):
+    model = tangled
+    solver = Solver(model, 8, 8, Random(0), max_restarts=1)
+    error = Contradiction()
+    solver.restart(error)
+    assert solver.restarts == 1
+    with pytest.raises(Contradiction) as raised:
+        solver.restart(error)
+    assert raised.value is error
+
+
+def test_undo_restores_wave_and_supports(tangled):
+    model = tangled
+    wave = Wave.empty(model, 6, 6)
+    propagator = Propagator(wave, trail=[])
+    possible = wave.possible.copy()
+    support = propagator.support.copy()
+    r = Random(0)
+    try:
+        for x in range(6):
+            propagator.observe(r, x, x)
+    except Contradiction:
+        pass
+    propagator.undo(0)
+    assert np.array_equal(wave.possible, possible)
+    assert np.array_equal(propagator.support, support)
+
+
+def test_events_replay_to_the_solved_map(tangled):
+    model = tangled
+    kinds = set()
+    for seed in range(4):
+        solver = Solver(model, 8, 8, Random(seed))
+        replayed = solver.wave.tiles()
+        for event in solver.events():
+            kinds.add(type(event))
+            if isinstance(event, Collapsed):
+                replayed[event.y, event.x] = event.tile_id
+            elif isinstance(event, DomainChanged):
+                assert event.remaining != 1
+                replayed[event.y, event.x] = -1
+            elif isinstance(event, Restarted):
+                replayed = solver.wave.tiles()
+        assert np.array_equal(replayed, solver.wave.tiles())
+        assert (replayed != -1).all()
+        # the same decisions as solving in one go
+        alone = Solver(model, 8, 8, Random(seed)).solve()
+        assert np.array_equal(replayed, alone)
+    assert Backtracked in kinds
+
+
+def test_generating_tile_ignores_set_order():
+    # 1 and 9 share a hash bucket, so sets holding both iterate in whichever
+    # order they were filled
+    model = train_on_array(np.array([[1, 9, 1, 1, 9], [9, 9, 1, 9, 1]]))
+    for seed in range(20):
+        chosen = []
+        for order in ([1, 9], [9, 1]):
+            in_progress = [[GeneratingTile() for y in range(2)] for x in range(2)]
+            in_progress[0][0].remaining = set(order)
+            in_progress[0][0].observe(Random(seed), 0, 0, 2, 2, in_progress, model)
+            chosen.append(in_progress[0][0].remaining)
+        assert chosen[0] == chosen[1]
+
+
+def test_stats_count_what_the_solver_did(tangled):
+    model = tangled
+    stats = Stats()
+    solver = Solver(model, 8, 8, Random(0), stats=stats)
+    solver.solve()
+    assert stats.counts["decisions"] == stats.timings["select"].count
+    assert stats.counts["backtracks"] == solver.backtracks > 0
+    assert stats.counts["restarts"] == solver.restarts
+    assert stats.counts["bans"] >= stats.counts["decisions"]
+    assert stats.peaks["queue"] > 0
+    propagate = stats.timings["propagate"]
+    assert propagate.count == stats.counts["decisions"]
+    assert sum(propagate.buckets) == propagate.count
+    assert propagate.longest >= propagate.mean > 0
+    assert len(stats.lines()) == 2 and "decisions" in stats.lines()[0]
+
+
+def test_connectivity_leaves_no_unreachable_pockets(passable_regions):
+    model = train_on_array(load_tile_map())
+    pockets = 0
+    for seed in range(3):
+        _, count = passable_regions(Solver(model, 14, 14, Random(seed)).solve())
+        pockets += count - 1
+        connectivity = Connectivity.from_solidity(model, TILE_SOLIDITY, everything=True)
+        solver = Solver(model, 14, 14, Random(seed), connectivity=connectivity)
+        assert passable_regions(solver.solve())[1] == 1
+    assert pockets
+
+
+def test_connectivity_joins_required_cells(passable_regions):
+    model = train_on_array(load_tile_map())
+    required = [(0, 0), (15, 3), (7, 11)]
+    for seed in range(3):
+        connectivity = Connectivity.from_solidity(
+            model, TILE_SOLIDITY, required=required
+        )
+        solver = Solver(model, 12, 16, Random(seed), connectivity=connectivity)
+        region, _ = passable_regions(solver.solve())
+        assert len({region[y, x] for x, y in required}) == 1
+        assert region[0, 0] >= 0
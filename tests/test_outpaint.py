@@ -0,0 +1,74 @@
+import time
+
+import numpy as np
+
+from wfc_model import (
+    Direction,
+    compass,
+    load_tile_map,
+    overlap,
+    pruned,
+    train_on_array,
+)
+from wfc_outpaint import Outpainter, World, screen_h, screen_w
+
+
+def test_world_from_map_round_trips():
+    overworld = load_tile_map()
+    world = World.from_map(train_on_array(overworld), overworld.tolist())
+    assert len(world.chunks) == 16 * 8
+    assert world.bounds() == (0, 0, 15, 7)
+    assert np.array_equal(world.region(0, 0, 256, 88), overworld)
+    assert (world.region(-2, -2, 4, 4)[:2] == -1).all()
+
+
+def test_generated_chunk_fits_its_border():
+    overworld = load_tile_map()
+    model = train_on_array(overworld)
+    world = World.from_map(model, overworld, seed=3)
+    assert world.extend(Direction.east)[0] == (16, 0)
+    # the new screen plus a ring of the original map around it
+    region = world.region(16 * screen_w - 1, 0, screen_w + 1, screen_h + 1)
+    assert (region != -1).all()
+    indexes = np.vectorize(model.index.get)(region)
+    for d, (_, (deltax, deltay)) in enumerate(compass):
+        here, there = overlap(deltax, deltay, *region.shape)
+        assert model.compatible[d, indexes[here], indexes[there]].all()
+
+
+def test_outpainter_matches_generating_in_place():
+    overworld = load_tile_map()
+    model = train_on_array(overworld)
+    world = World.from_map(model, overworld, seed=5)
+    with Outpainter(world, workers=2) as painter:
+        assert painter.request((16, 3))
+        # shares tiles with (16, 3), so has to wait for it
+        assert not painter.request((17, 4))
+        assert painter.request((18, 0))
+        deadline = time.monotonic() + 60
+        added = []
+        while len(added) < 2 and time.monotonic() < deadline:
+            added += painter.collect()
+            time.sleep(0.01)
+    assert sorted(added) == [(16, 3), (18, 0)]
+    expected = World.from_map(model, overworld, seed=5)
+    assert np.array_equal(world.chunks[(16, 3)], expected.generate(16, 3))
+    assert np.array_equal(world.chunks[(18, 0)], expected.generate(18, 0))
+
+
+def test_outpainter_gives_up_on_tiles_a_pruned_model_lacks():
+    # 5 only sits on the top edge, and 7 only below it, so pruning drops both
+    tiles = np.ones((screen_h, screen_w), dtype=np.int64)
+    tiles[0, -1], tiles[1, -1] = 5, 7
+    model = pruned(train_on_array(tiles))
+    assert model.tile_ids == (1,)
+    world = World.from_map(model, tiles)
+    with Outpainter(world) as painter:
+        for chunk in [(1, 0), (0, 1)]:
+            assert painter.request(chunk)
+            deadline = time.monotonic() + 60
+            while painter.running and time.monotonic() < deadline:
+                painter.collect()
+                time.sleep(0.01)
+    assert painter.failed == {(1, 0)}
+    assert (world.chunks[(0, 1)] == 1).all()
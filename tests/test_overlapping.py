@@ -0,0 +1,36 @@
+from random import Random
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from wfc_model import load_tile_map
+from wfc_overlapping import generate_overlapping, train_overlapping
+
+
+def test_patterns_are_unique_with_counts():
+    training = np.array([[1, 2, 1, 2], [3, 3, 3, 3], [1, 2, 1, 2]])
+    model = train_overlapping(training, 2)
+    assert len(model.patterns) == 4
+    windows = {tuple(each.ravel()) for each in model.patterns}
+    assert (1, 2, 3, 3) in windows and (3, 3, 2, 1) in windows
+    assert np.isclose(model.compiled.weights.sum(), 1)
+    # [[1, 2], [3, 3]] can only have [[2, 1], [3, 3]] east of it
+    ones = [tuple(p.ravel()) for p in model.patterns].index((1, 2, 3, 3))
+    (east,) = np.flatnonzero(model.compiled.compatible[1, ones])
+    assert tuple(model.patterns[east].ravel()) == (2, 1, 3, 3)
+
+
+def test_symmetry_adds_rotations():
+    training = np.array([[1, 2], [3, 4]])
+    assert len(train_overlapping(training, 2).patterns) == 1
+    assert len(train_overlapping(training, 2, symmetry=True).patterns) == 8
+
+
+def test_generated_windows_all_come_from_training():
+    training = load_tile_map()[:22, :32]
+    model = train_overlapping(training, 2)
+    tiles = generate_overlapping(model, 12, 14, Random(2))
+    assert tiles.shape == (12, 14)
+    known = {tuple(each.ravel()) for each in model.patterns}
+    for window in sliding_window_view(tiles, (2, 2)).reshape(-1, 4):
+        assert tuple(window) in known
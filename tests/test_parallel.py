@@ -0,0 +1,33 @@
+from random import Random
+
+import numpy as np
+import pytest
+
+from wfc_model import Contradiction, Solver, load_tile_map, train_on_array
+from wfc_parallel import generate_parallel, solve_portfolio, spans
+
+
+def test_spans_alternate_blocks_and_seams():
+    assert spans(20, 6, 2) == ([(0, 6), (8, 14), (16, 20)], [(6, 8), (14, 16)])
+    assert spans(7, 6, 2) == ([(0, 6)], [(6, 7)])
+
+
+def test_generate_parallel_is_consistent_and_repeatable(consistent):
+    model = train_on_array(load_tile_map())
+    tiles = generate_parallel(model, 24, 30, seed=5, block=(10, 12), workers=2)
+    assert (tiles != -1).all()
+    assert consistent(model, tiles)
+    again = generate_parallel(model, 24, 30, seed=5, block=(10, 12), workers=2)
+    assert np.array_equal(tiles, again)
+
+
+def test_portfolio_winner_is_reproducible(tangled):
+    model = tangled
+    options = dict(max_backtracks=0, max_restarts=0)
+    winner = solve_portfolio(model, 8, 8, range(12), workers=2, **options)
+    assert winner.seed not in winner.failed
+    alone = Solver(model, 8, 8, Random(winner.seed), **options).solve()
+    assert np.array_equal(winner.tiles, alone)
+    for seed in winner.failed:
+        with pytest.raises(Contradiction):
+            Solver(model, 8, 8, Random(seed), **options).solve()
@@ -1,6 +1,23 @@
-from wfc_render import hex_to_int, load_tile_images, init_display
+import numpy as np
+import pygame
+from pygame import Rect, Surface
 from pytest import fixture
 
+from wfc_model import train_on_array
+from wfc_outpaint import World
+from wfc_render import (
+    CellView,
+    MapSurfaces,
+    WorldSurfaces,
+    hex_to_int,
+    init_display,
+    load_image,
+    load_tile_atlas,
+    load_tile_images,
+    parse_tile_map,
+    wanted_screens,
+)
+
 
 @fixture(scope="module")
 def display():
@@ -15,4 +32,78 @@ def test_hex_to_int():
 
 def test_load_tile_images(display):
     images = load_tile_images()
-    assert len(images) == 160
\ No newline at end of file
+    assert len(images) == 160
+
+
+def test_map_surfaces_match_tile_by_tile(display):
+    tiles = load_tile_images()
+    overworld = parse_tile_map()
+    surfaces = MapSurfaces(tiles, overworld)
+    cached = Surface((600, 600))
+    surfaces.draw(cached, 13, 9)
+    # a 20 x 20 view from (13, 9) overlaps three screens each way
+    assert len(surfaces.screens) == 9
+    expected = Surface((600, 600))
+    for y in range(20):
+        for x in range(20):
+            expected.blit(tiles[overworld[9 + y][13 + x]], (x * 30, y * 30))
+    assert pygame.image.tobytes(cached, "RGB") == pygame.image.tobytes(expected, "RGB")
+
+
+def test_cell_view_only_redraws_changes(display):
+    view = CellView(load_tile_images(), 2, 3, origin=(0, 60))
+    grid = np.full((2, 3), -1)
+    assert len(view.draw(display, grid)) == 6
+    assert view.draw(display, grid) == []
+    grid[1, 2] = 5
+    assert view.draw(display, grid) == [Rect(60, 90, 30, 30)]
+    assert view.paint(display, [(0, 0, 7), (2, 1, 5)]) == [Rect(0, 60, 30, 30)]
+    grid[0, 0] = 7
+    assert view.draw(display, grid) == []
+
+
+def test_atlas_matches_individual_tiles(display, tmp_path):
+    atlas = load_tile_atlas(cache_dir=tmp_path)
+    (cached,) = tmp_path.glob("*-30.png")
+    again = load_tile_atlas(cache_dir=tmp_path)
+    for i, tile in enumerate(atlas):
+        single = load_image(f"./data/tiles/overworld_tile_{i}.png")
+        assert tile.get_size() == single.get_size() == (30, 30)
+        expected = pygame.image.tobytes(single, "RGB")
+        assert pygame.image.tobytes(tile, "RGB") == expected
+        assert pygame.image.tobytes(again[i], "RGB") == expected
+
+
+def test_world_surfaces_placeholders_and_lru(display):
+    tiles = load_tile_images()
+    overworld = np.array(parse_tile_map())
+    world = World.from_map(train_on_array(overworld), overworld)
+    surfaces = WorldSurfaces(tiles, world, max_screens=2)
+    drawn = Surface((600, 600))
+    # 20 x 20 from 16 tiles short of the overworld's east edge: the two
+    # screens past it are not generated yet
+    surfaces.draw(drawn, 240, 0)
+    assert list(surfaces.screens) == [(15, 0), (15, 1)]
+    expected = Surface((600, 600))
+    MapSurfaces(tiles, overworld.tolist()).draw(expected, 240, 0)
+    known = Rect(0, 0, 480, 600)
+    assert pygame.image.tobytes(drawn.subsurface(known), "RGB") == pygame.image.tobytes(
+        expected.subsurface(known), "RGB"
+    )
+    assert pygame.image.tobytes(
+        drawn.subsurface(Rect(480, 0, 120, 330)), "RGB"
+    ) == pygame.image.tobytes(surfaces.placeholder.subsurface(0, 0, 120, 330), "RGB")
+    surfaces.draw(drawn, 200, 0)
+    assert list(surfaces.screens) == [(12, 1), (13, 1)]
+
+
+def test_wanted_screens_are_in_view_then_ahead():
+    assert wanted_screens(240, 0, (1, 0)) == [
+        (15, 0),
+        (16, 0),
+        (15, 1),
+        (16, 1),
+        (17, 0),
+        (17, 1),
+    ]
+    assert wanted_screens(0, 0, (0, -1))[-2:] == [(0, -1), (1, -1)]
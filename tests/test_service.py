@@ -0,0 +1,80 @@
+import asyncio
+from random import Random
+
+import numpy as np
+import pytest
+
+from wfc_cache import ResultCache
+from wfc_model import Solver, load_tile_map, train_on_array
+from wfc_service import GenerationService, Request, decode, encode, fetch
+
+
+def test_encode_picks_the_narrowest_type():
+    small = np.array([[1, 2, 3], [4, 5, 255]])
+    assert len(encode(small)) == 5 + 6
+    assert np.array_equal(decode(encode(small)), small)
+    free = np.array([[-1, 7], [300, -1]])
+    assert decode(encode(free)).dtype.kind == "i"
+    assert np.array_equal(decode(encode(free)), free)
+    with pytest.raises(ValueError):
+        decode(encode(small)[:-1])
+
+
+def test_service_coalesces_identical_requests():
+    model = train_on_array(load_tile_map())
+    constraints = np.full((8, 9), -1)
+    constraints[4, 4] = model.tile_ids[0]
+
+    async def scenario():
+        async with GenerationService(
+            model, workers=1, results=ResultCache()
+        ) as service:
+            server = await asyncio.start_server(service.handle, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                results = await asyncio.gather(
+                    fetch("127.0.0.1", port, 8, 9, seed=4),
+                    fetch("127.0.0.1", port, 8, 9, seed=4),
+                    fetch("127.0.0.1", port, 8, 9, 4, constraints),
+                )
+                with pytest.raises(ValueError, match="400"):
+                    await fetch("127.0.0.1", port, 8, 9, 4, constraints[:2])
+                # answered from the result cache this time
+                again = await fetch("127.0.0.1", port, 8, 9, seed=4)
+                assert np.array_equal(again, results[0])
+            return results, service.solves
+
+    (first, second, fixed), solves = asyncio.run(scenario())
+    assert solves == 2
+    assert np.array_equal(first, second)
+    assert np.array_equal(first, Solver(model, 8, 9, Random(4)).solve())
+    assert fixed[4, 4] == model.tile_ids[0]
+
+
+def test_bad_request_only_fails_itself():
+    model = train_on_array(load_tile_map())
+    bad = np.full((6, 6), -1)
+    bad[0, 0] = 250
+    requests = [Request(6, 6, 1), Request(6, 6, 2, encode(bad)), Request(6, 6, 3)]
+
+    async def scenario():
+        async with GenerationService(model, workers=1, batch_delay=0.05) as service:
+            # turned away before it is queued
+            through_service = await asyncio.gather(
+                *(service.generate(request) for request in requests),
+                return_exceptions=True,
+            )
+            # and if one does reach a worker, the rest of its batch still solves
+            loop = asyncio.get_running_loop()
+            batch = [(request, loop.create_future()) for request in requests]
+            await service.run(batch)
+            in_batch = await asyncio.gather(
+                *(future for _, future in batch), return_exceptions=True
+            )
+        return through_service, in_batch
+
+    for first, failed, third in asyncio.run(scenario()):
+        assert isinstance(failed, ValueError)
+        assert "250" in str(failed)
+        assert np.array_equal(first, Solver(model, 6, 6, Random(1)).solve())
+        assert np.array_equal(third, Solver(model, 6, 6, Random(3)).solve())
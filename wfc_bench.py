@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass, field
+from random import Random
+from typing import Callable, TypeVar
+
+import numpy as np
+
+from wfc_headless import compose, tile_atlas
+from wfc_model import (
+    CompiledSet,
+    Contradiction,
+    Scheduler,
+    Solver,
+    Wave,
+    compile_trained,
+    load_tile_map,
+    train_on_array,
+    train_on_map,
+)
+
+T = TypeVar("T")
+
+# (h, w): a viewer's worth, the whole overworld, and a big synthetic world
+small = (20, 20)
+overworld = (88, 256)
+huge = (1024, 1024)
+
+
+@dataclass
+class Result:
+    name: str
+    size: tuple[int, int]
+    seconds: float
+    # median wall time of one run
+    runs: int
+    peak_bytes: int
+    # most memory traced at once during a separate, traced run
+    metrics: dict[str, float] = field(default_factory=dict)
+
+
+def timed(function: Callable[[], T], repeat: int) -> tuple[float, int, T]:
+    # median seconds over repeat runs, then the peak memory of one more
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), peak_memory(function), result
+
+
+def peak_memory(function: Callable[[], object]) -> int:
+    # run apart from the timed runs, which tracemalloc would slow down
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def synthetic_map(h: int, w: int) -> np.ndarray:
+    # the overworld repeated to size; the seams add a few new neighbours
+    source = load_tile_map()
+    reps = (-(-h // source.shape[0]), -(-w // source.shape[1]))
+    return np.ascontiguousarray(np.tile(source, reps)[:h, :w])
+
+
+def bench_training(training: np.ndarray, repeat: int) -> list[Result]:
+    h, w = training.shape
+    seconds, peak, _ = timed(lambda: train_on_array(training), repeat)
+    results = [
+        Result(
+            "train_on_array",
+            (h, w),
+            seconds,
+            repeat,
+            peak,
+            {"cells_per_second": h * w / seconds},
+        )
+    ]
+    if h * w <= overworld[0] * overworld[1]:
+        rows = training.tolist()
+        seconds, peak, _ = timed(lambda: compile_trained(train_on_map(rows)), repeat)
+        results.append(
+            Result(
+                "train_on_map",
+                (h, w),
+                seconds,
+                repeat,
+                peak,
+                {"cells_per_second": h * w / seconds},
+            )
+        )
+    return results
+
+
+def bench_solve(model: CompiledSet, h: int, w: int, seeds: range) -> Result:
+    # one solve per seed; a contradiction is a seed that needed a restart or
+    # gave up altogether
+    times = []
+    contradictions = 0
+    backtracks = 0
+    for seed in seeds:
+        solver = Solver(model, h, w, Random(seed))
+        start = time.perf_counter()
+        try:
+            solver.solve()
+        except Contradiction:
+            contradictions += 1
+        else:
+            contradictions += solver.restarts > 0
+        times.append(time.perf_counter() - start)
+        backtracks += solver.backtracks
+    seconds = statistics.median(times)
+    return Result(
+        "solve",
+        (h, w),
+        seconds,
+        len(seeds),
+        peak_memory(lambda: Solver(model, h, w, Random(seeds[0])).attempt()),
+        {
+            "collapses_per_second": h * w / seconds,
+            "contradiction_rate": contradictions / len(seeds),
+            "backtracks_per_solve": backtracks / len(seeds),
+        },
+    )
+
+
+def bench_selection(model: CompiledSet, h: int, w: int, repeat: int) -> Result:
+    # the min-entropy heap alone: queue every cell, then pick them all
+    wave = Wave.empty(model, h, w)
+    # every cell a different, still undecided entropy
+    r = np.random.default_rng(0)
+    wave.possible &= r.random(wave.possible.shape) < 0.5
+    wave.possible[:, :, :2] = True
+    wave.recount()
+
+    def select() -> int:
+        scheduler = Scheduler(wave, Random(0))
+        for y in range(h):
+            for x in range(w):
+                scheduler.touch(x, y)
+        # each cell has one live entry, so this pops every cell once
+        picks = 0
+        while scheduler.pick() is not None:
+            picks += 1
+        return picks
+
+    seconds, peak, picks = timed(select, repeat)
+    return Result(
+        "select", (h, w), seconds, repeat, peak, {"picks_per_second": picks / seconds}
+    )
+
+
+def bench_render(h: int, w: int, size: int, repeat: int) -> Result:
+    # headless frames: a fresh grid of tile ids composed into pixels
+    atlas = tile_atlas(size)
+    grid = np.random.default_rng(0).integers(0, len(atlas), (h, w))
+    seconds, peak, _ = timed(lambda: compose(grid, atlas), repeat)
+    return Result(
+        f"render_{size}px",
+        (h, w),
+        seconds,
+        repeat,
+        peak,
+        {"frames_per_second": 1 / seconds},
+    )
+
+
+def run(
+    quick: bool = False, solve_sizes: list[tuple[int, int]] | None = None
+) -> list[Result]:
+    # quick: fewer repeats and seeds, e.g. to check the suite itself runs;
+    # solving 1024 x 1024 needs about a GB for the wave and supports, so it
+    # only happens when asked for in solve_sizes
+    repeat = 1 if quick else 5
+    seeds = range(2 if quick else 5)
+    if solve_sizes is None:
+        solve_sizes = [small] if quick else [small, overworld]
+    model = train_on_array(load_tile_map())
+    results = []
+    for size in (small, overworld, huge):
+        results += bench_training(synthetic_map(*size), repeat)
+    for h, w in solve_sizes:
+        results.append(bench_solve(model, h, w, seeds))
+    for h, w in (small, overworld):
+        results.append(bench_selection(model, h, w, repeat))
+    results.append(bench_render(*small, 30, repeat))
+    for size in (small, overworld, huge):
+        results.append(bench_render(*size, 16 if size != huge else 4, repeat))
+    return results
+
+
+def report(results: list[Result]) -> dict[str, object]:
+    return {
+        "time": time.time(),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": [asdict(each) for each in results],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Time the generation hot paths")
+    parser.add_argument("--json", help="also write the results here")
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument(
+        "--solve",
+        action="append",
+        metavar="HxW",
+        help="solve this size instead of the defaults; repeatable",
+    )
+    args = parser.parse_args()
+    solve_sizes = None
+    if args.solve:
+        solve_sizes = [
+            (int(h), int(w)) for h, w in (each.split("x") for each in args.solve)
+        ]
+    results = run(args.quick, solve_sizes)
+    for each in results:
+        metrics = ", ".join(
+            f"{name} {value:,.2f}" for name, value in each.metrics.items()
+        )
+        print(
+            f"{each.name:>16} {each.size[0]:>5}x{each.size[1]:<5}"
+            f" {each.seconds * 1000:>10.2f}ms {each.peak_bytes / 2**20:>8.1f}MiB"
+            f"  {metrics}"
+        )
+    if args.json:
+        with open(args.json, "w") as file_pointer:
+            json.dump(report(results), file_pointer, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import zipfile
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from random import Random
+from typing import Any
+
+import numpy as np
+
+from wfc_model import CompiledSet, Solver, decode_tile_map, train_on_array
+
+cache_root = Path(".wfc_cache")
+
+# bump whenever training or the saved layout changes, to orphan old entries
+model_format = 1
+
+# the Solver options, besides connectivity, that change which map comes out
+result_options = ("max_depth", "max_backtracks", "max_restarts")
+
+
+def model_key(source: bytes, options: dict[str, object]) -> str:
+    digest = hashlib.sha256(source)
+    digest.update(json.dumps([model_format, options], sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def cached_model(
+    path: str = "data/zelda_overworld_map.txt",
+    cache_dir: Path = cache_root / "models",
+    max_bytes: int = 64 * 1024 * 1024,
+    **options: object,
+) -> CompiledSet:
+    # options are passed on to train_on_array and are part of the key
+    with open(path, "rb") as file_pointer:
+        source = file_pointer.read()
+    target = cache_dir / f"{model_key(source, options)}.npz"
+    if target.exists():
+        try:
+            model = CompiledSet.load(target)
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # half-written or from an incompatible numpy; train it again
+            pass
+        else:
+            # mtime doubles as the last-used time for evict()
+            os.utime(target)
+            return model
+    model = train_on_array(decode_tile_map(source.decode("ascii")), **options)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    partial = target.with_suffix(f".{os.getpid()}.tmp")
+    model.save(partial)
+    os.replace(partial, target)
+    evict(cache_dir, max_bytes, keep=target)
+    return model
+
+
+def evict(
+    cache_dir: Path, max_bytes: int, keep: Path | None = None, pattern: str = "*.npz"
+) -> None:
+    # drop least recently used entries until the directory fits in max_bytes
+    entries = sorted(
+        (each.stat().st_mtime, each.stat().st_size, each)
+        for each in cache_dir.glob(pattern)
+    )
+    total = sum(size for _, size, _ in entries)
+    for _, size, each in entries:
+        if total <= max_bytes:
+            break
+        if each == keep:
+            continue
+        each.unlink(missing_ok=True)
+        total -= size
+
+
+def result_key(
+    model: CompiledSet,
+    h: int,
+    w: int,
+    seed: int | str,
+    constraints: np.ndarray | None = None,
+    options: dict[str, Any] | None = None,
+) -> str:
+    # everything Solver(model, h, w, Random(seed), constraints, **options)
+    # depends on, so equal keys always mean equal maps; options that only
+    # watch or interrupt the solve, like stats and should_stop, are left out
+    options = options or {}
+    keyed: dict[str, Any] = {
+        name: options[name] for name in result_options if name in options
+    }
+    connectivity = options.get("connectivity")
+    if connectivity is not None:
+        keyed["connectivity"] = [
+            [list(cell) for cell in connectivity.required],
+            connectivity.everything,
+        ]
+    digest = hashlib.sha256(model.digest.encode())
+    digest.update(
+        json.dumps([model_format, h, w, seed, keyed], sort_keys=True).encode()
+    )
+    if connectivity is not None:
+        digest.update(np.ascontiguousarray(connectivity.passable, dtype=bool).tobytes())
+    if constraints is not None:
+        digest.update(np.ascontiguousarray(constraints, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+
+@dataclass
+class ResultCache:
+    # solved maps by result_key(): the most recent in memory, and all of them
+    # on disk too if cache_dir is set
+    max_entries: int = 256
+    cache_dir: Path | None = None
+    max_bytes: int = 256 * 1024 * 1024
+    entries: OrderedDict[str, np.ndarray] = field(default_factory=OrderedDict)
+    hits: int = 0
+    misses: int = 0
+
+    def get(self, key: str) -> np.ndarray | None:
+        tiles = self.entries.get(key)
+        if tiles is not None:
+            self.entries.move_to_end(key)
+        elif self.cache_dir is not None:
+            target = self.cache_dir / f"{key}.npy"
+            try:
+                tiles = np.load(target)
+            except (OSError, ValueError, EOFError):
+                # missing, or half-written
+                pass
+            else:
+                os.utime(target)
+                self.remember(key, tiles)
+        if tiles is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return tiles
+
+    def put(self, key: str, tiles: np.ndarray) -> np.ndarray:
+        tiles = self.remember(key, tiles.copy())
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            target = self.cache_dir / f"{key}.npy"
+            partial = target.with_suffix(f".{os.getpid()}.tmp")
+            with open(partial, "wb") as file_pointer:
+                np.save(file_pointer, tiles)
+            os.replace(partial, target)
+            evict(self.cache_dir, self.max_bytes, keep=target, pattern="*.npy")
+        return tiles
+
+    def remember(self, key: str, tiles: np.ndarray) -> np.ndarray:
+        # shared between callers, so nobody gets to change it
+        tiles.setflags(write=False)
+        self.entries[key] = tiles
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return tiles
+
+    def generate(
+        self,
+        model: CompiledSet,
+        h: int,
+        w: int,
+        seed: int | str,
+        constraints: np.ndarray | None = None,
+        **options: Any,
+    ) -> np.ndarray:
+        # options are passed on to the Solver, and those that change the map
+        # are part of the key
+        key = result_key(model, h, w, seed, constraints, options)
+        tiles = self.get(key)
+        if tiles is None:
+            solver = Solver(
+                model, h, w, Random(seed), constraints=constraints, **options
+            )
+            tiles = self.put(key, solver.solve())
+        return tiles
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import os
+import struct
+import sys
+from collections.abc import Mapping
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+from wfc_model import CompiledSet, decode_tile_map, encode_tile_map
+from wfc_outpaint import Chunk, World, screen_h, screen_w
+
+# a world file is this header, then one index entry per chunk, then the
+# chunks themselves: (chunk h, chunk w) tile ids each, row-major, starting at
+# the offset (from the start of the file) their entry gives
+magic = b"WFCW"
+version = 1
+# magic, version, numpy type code (B or H), chunk h, chunk w, chunk count
+header = struct.Struct("<4sBcHHI")
+index_entry = np.dtype([("x", "<i4"), ("y", "<i4"), ("offset", "<u8")])
+# chunk data starts on a multiple of this, so every chunk is aligned
+alignment = 16
+
+
+def write_world(
+    path: str | Path,
+    chunks: Mapping[Chunk, np.ndarray],
+    shape: tuple[int, int] = (screen_h, screen_w),
+) -> None:
+    # chunks in row-major order, so screens that are drawn together tend to
+    # sit together on disk; replaced atomically, as readers may have it mapped
+    keys = sorted(chunks, key=lambda chunk: (chunk[1], chunk[0]))
+    tiles = [np.asarray(chunks[chunk]) for chunk in keys]
+    if any(each.shape != shape for each in tiles):
+        raise ValueError(f"every chunk has to be {shape[0]} x {shape[1]} tiles")
+    if any(each.size and each.min() < 0 for each in tiles):
+        raise ValueError("only whole chunks can be saved")
+    wide = any(each.size and each.max() > 255 for each in tiles)
+    dtype = np.dtype("<u2" if wide else "u1")
+    if wide and any(each.max() > 65535 for each in tiles):
+        raise ValueError("tile ids have to fit in 16 bits")
+    start = -(-(header.size + len(keys) * index_entry.itemsize) // alignment)
+    start *= alignment
+    size = shape[0] * shape[1] * dtype.itemsize
+    index = np.zeros(len(keys), dtype=index_entry)
+    index["x"] = [chunkx for chunkx, _ in keys]
+    index["y"] = [chunky for _, chunky in keys]
+    index["offset"] = start + np.arange(len(keys), dtype=np.uint64) * size
+    path = Path(path)
+    partial = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(partial, "wb") as file_pointer:
+        file_pointer.write(
+            header.pack(magic, version, dtype.char.encode(), *shape, len(keys))
+        )
+        file_pointer.write(index.tobytes())
+        file_pointer.write(bytes(start - file_pointer.tell()))
+        for each in tiles:
+            file_pointer.write(each.astype(dtype).tobytes())
+    os.replace(partial, path)
+
+
+@dataclass
+class WorldFile(Mapping[Chunk, np.ndarray]):
+    # the chunks of a world file by (chunkx, chunky), read through a memory
+    # map: only the pages of the chunks actually looked at are ever read
+    data: np.ndarray
+    dtype: np.dtype
+    shape: tuple[int, int]
+    offsets: dict[Chunk, int]
+
+    @classmethod
+    def open(cls, path: str | Path) -> WorldFile:
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        if len(data) < header.size:
+            raise ValueError(f"{path} is too short to be a world file")
+        found, found_version, code, h, w, count = header.unpack_from(data)
+        if found != magic or found_version != version:
+            raise ValueError(f"{path} is not a version {version} world file")
+        if code not in (b"B", b"H"):
+            raise ValueError(f"{path}: unknown tile type {code!r}")
+        dtype = np.dtype(code.decode()).newbyteorder("<")
+        index = np.frombuffer(data, index_entry, count, offset=header.size)
+        end = int(index["offset"].max()) + h * w * dtype.itemsize if count else 0
+        if end > len(data):
+            raise ValueError(f"{path} is truncated")
+        offsets = {
+            (int(x), int(y)): int(offset)
+            for x, y, offset in zip(index["x"], index["y"], index["offset"])
+        }
+        return cls(data, dtype, (h, w), offsets)
+
+    def __getitem__(self, chunk: Chunk) -> np.ndarray:
+        offset = self.offsets[chunk]
+        size = self.shape[0] * self.shape[1] * self.dtype.itemsize
+        return self.data[offset : offset + size].view(self.dtype).reshape(self.shape)
+
+    def __iter__(self) -> Iterator[Chunk]:
+        return iter(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def world(self, model: CompiledSet, seed: int = 0) -> World:
+        # chunks stay mapped until something is generated next to them
+        assert self.shape == (screen_h, screen_w), "World chunks are screens"
+        return World(model, seed, dict(self))
+
+    def tiles(self) -> np.ndarray:
+        # the whole world as one array; only for worlds without gaps
+        xs = [chunkx for chunkx, _ in self.offsets]
+        ys = [chunky for _, chunky in self.offsets]
+        if not self.offsets:
+            return np.zeros((0, 0), dtype=self.dtype)
+        minx, miny = min(xs), min(ys)
+        columns, rows = max(xs) - minx + 1, max(ys) - miny + 1
+        if columns * rows != len(self.offsets):
+            raise ValueError("the world has gaps, so it is not one rectangle")
+        h, w = self.shape
+        result = np.zeros((rows * h, columns * w), dtype=self.dtype)
+        for chunkx, chunky in self.offsets:
+            top, left = (chunky - miny) * h, (chunkx - minx) * w
+            result[top : top + h, left : left + w] = self[(chunkx, chunky)]
+        return result
+
+
+def import_hex(text_path: str | Path, world_path: str | Path) -> None:
+    # a map in the hex text format, cut into screens with (0, 0) top left
+    with open(text_path, "r") as file_pointer:
+        tiles = decode_tile_map(file_pointer.read())
+    h, w = tiles.shape
+    if h % screen_h or w % screen_w:
+        raise ValueError(f"{text_path} is not made of whole screens")
+    write_world(
+        world_path,
+        {
+            (chunkx, chunky): tiles[
+                chunky * screen_h : (chunky + 1) * screen_h,
+                chunkx * screen_w : (chunkx + 1) * screen_w,
+            ]
+            for chunky in range(h // screen_h)
+            for chunkx in range(w // screen_w)
+        },
+    )
+
+
+def export_hex(world_path: str | Path, text_path: str | Path) -> None:
+    text = encode_tile_map(WorldFile.open(world_path).tiles())
+    with open(text_path, "w") as file_pointer:
+        file_pointer.write(text)
+
+
+if __name__ == "__main__":
+    # python wfc_chunks.py import map.txt world.wfcw, or export world.wfcw map.txt
+    command, source, target = sys.argv[1:]
+    {"import": import_hex, "export": export_hex}[command](source, target)
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import struct
+import zlib
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+# the Walking Tour sheet is 18 x 8 tiles of 16 pixels, each inside a 1 pixel
+# grid line; tile ids run 20 to a row, so the last two of every row are blank
+sheet_columns = 18
+sheet_tile = 16
+atlas_columns = 20
+atlas_rows = 8
+
+# 1 for tiles that block movement, by tile id
+# fmt: off
+TILE_SOLIDITY = [
+    0, 1, 0, 1, 1, 1, 0, 1, 1, 1, 1, 1, 0, 1, 0, 1, 1, 1, 0, 0,
+    0, 1, 1, 1, 0, 1, 0, 1, 1, 1, 1, 1, 0, 1, 1, 1, 0, 1, 0, 0,
+    1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0,
+    1, 1, 1, 1, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 1, 0, 0,
+    1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0,
+    1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0,
+    1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0,
+    0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 0, 0, 0,
+]
+# fmt: on
+
+png_signature = b"\x89PNG\r\n\x1a\n"
+# PNG colour type -> channels, for the 8 bit types we read
+png_channels = {0: 1, 2: 3, 4: 2, 6: 4}
+
+
+def read_png(path: str | Path) -> np.ndarray:
+    # (h, w, channels) uint8 pixels of an 8 bit, non-interlaced PNG, with only
+    # the standard library and numpy; enough for the tile sheet
+    with open(path, "rb") as file_pointer:
+        data = file_pointer.read()
+    if not data.startswith(png_signature):
+        raise ValueError(f"{path} is not a PNG")
+    position = len(png_signature)
+    compressed = []
+    while position < len(data):
+        (length,) = struct.unpack(">I", data[position : position + 4])
+        kind = data[position + 4 : position + 8]
+        body = data[position + 8 : position + 8 + length]
+        position += 12 + length
+        if kind == b"IHDR":
+            w, h, depth, colour, _, _, interlace = struct.unpack(">IIBBBBB", body)
+            if depth != 8 or colour not in png_channels or interlace:
+                raise ValueError(f"{path}: only 8 bit non-interlaced PNGs")
+        elif kind == b"IDAT":
+            compressed.append(body)
+        elif kind == b"IEND":
+            break
+    channels = png_channels[colour]
+    stride = w * channels
+    raw = np.frombuffer(zlib.decompress(b"".join(compressed)), dtype=np.uint8)
+    rows = raw.reshape(h, stride + 1)
+    pixels = np.zeros((h, stride), dtype=np.uint8)
+    previous = np.zeros(stride, dtype=np.uint8)
+    for y in range(h):
+        kind, line = rows[y, 0], rows[y, 1:]
+        if kind == 0:
+            current = line.copy()
+        elif kind == 1:
+            # bytes are stored relative to the pixel to their left, so
+            # undoing that is a running sum along the row
+            current = np.cumsum(
+                line.reshape(w, channels), axis=0, dtype=np.uint8
+            ).ravel()
+        elif kind == 2:
+            current = line + previous
+        elif kind in (3, 4):
+            current = unfilter_sequential(kind, line, previous, channels)
+        else:
+            raise ValueError(f"{path}: unknown filter {kind} on row {y}")
+        pixels[y] = previous = current
+    return pixels.reshape(h, w, channels)
+
+
+def unfilter_sequential(
+    kind: int, line: np.ndarray, previous: np.ndarray, channels: int
+) -> np.ndarray:
+    # average and Paeth depend on the byte just decoded, so go one at a time
+    out = line.tolist()
+    above = previous.tolist()
+    for i in range(len(out)):
+        left = out[i - channels] if i >= channels else 0
+        up = above[i]
+        if kind == 3:
+            out[i] = (out[i] + (left + up) // 2) & 0xFF
+        else:
+            corner = above[i - channels] if i >= channels else 0
+            estimate = left + up - corner
+            pleft, pup, pcorner = (
+                abs(estimate - left),
+                abs(estimate - up),
+                abs(estimate - corner),
+            )
+            if pleft <= pup and pleft <= pcorner:
+                predicted = left
+            elif pup <= pcorner:
+                predicted = up
+            else:
+                predicted = corner
+            out[i] = (out[i] + predicted) & 0xFF
+    return np.array(out, dtype=np.uint8)
+
+
+def write_png(path: str | Path, pixels: np.ndarray, level: int = 1) -> None:
+    # (h, w, 3) or (h, w, 4) uint8 pixels; every row unfiltered, which with a
+    # low zlib level is what keeps writing cheap next to composing
+    h, w, channels = pixels.shape
+    colour = {channels: kind for kind, channels in png_channels.items()}[channels]
+    rows = np.zeros((h, w * channels + 1), dtype=np.uint8)
+    rows[:, 1:] = pixels.reshape(h, -1)
+    with open(path, "wb") as file_pointer:
+        file_pointer.write(png_signature)
+        for kind, body in (
+            (b"IHDR", struct.pack(">IIBBBBB", w, h, 8, colour, 0, 0, 0)),
+            (b"IDAT", zlib.compress(rows.tobytes(), level)),
+            (b"IEND", b""),
+        ):
+            file_pointer.write(struct.pack(">I", len(body)))
+            file_pointer.write(kind + body)
+            file_pointer.write(struct.pack(">I", zlib.crc32(kind + body)))
+
+
+def tile_atlas(
+    size: int = sheet_tile, path: str | Path = "data/zelda_overworld_tiles.png"
+) -> np.ndarray:
+    # (160, size, size, 3): every tile by id, scaled nearest-neighbour the way
+    # pygame.transform.scale does it
+    sheet = read_png(path)[:, :, :3]
+    tiles = np.zeros(
+        (atlas_rows, atlas_columns, sheet_tile, sheet_tile, 3), dtype=np.uint8
+    )
+    for row in range(atlas_rows):
+        top = row * (sheet_tile + 1) + 1
+        strip = sheet[top : top + sheet_tile, 1:]
+        # cut the grid lines out of the strip, one column of tiles per slice
+        strip = strip[:, : sheet_columns * (sheet_tile + 1)].reshape(
+            sheet_tile, sheet_columns, sheet_tile + 1, 3
+        )[:, :, :sheet_tile]
+        tiles[row, :sheet_columns] = strip.transpose(1, 0, 2, 3)
+    tiles = tiles.reshape(-1, sheet_tile, sheet_tile, 3)
+    if size != sheet_tile:
+        picks = np.arange(size) * sheet_tile // size
+        tiles = tiles[:, picks][:, :, picks]
+    return np.ascontiguousarray(tiles)
+
+
+def compose(grid: np.ndarray, atlas: np.ndarray) -> np.ndarray:
+    # (h * size, w * size, 3) image of a grid of tile ids, in one gather
+    h, w = grid.shape
+    size = atlas.shape[1]
+    return (
+        atlas[grid].transpose(0, 2, 1, 3, 4).reshape(h * size, w * size, atlas.shape[3])
+    )
+
+
+def export(grid: np.ndarray, path: str | Path, atlas: np.ndarray) -> None:
+    # .png for an image, anything else for the raw (h, w, 3) pixel bytes
+    pixels = compose(grid, atlas)
+    if Path(path).suffix == ".png":
+        write_png(path, pixels)
+    else:
+        pixels.tofile(path)
+
+
+def export_batch(
+    grids: Iterable[np.ndarray],
+    directory: str | Path,
+    atlas: np.ndarray,
+    suffix: str = ".png",
+) -> list[Path]:
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i, grid in enumerate(grids):
+        path = directory / f"map_{i}{suffix}"
+        export(grid, path, atlas)
+        paths.append(path)
+    return paths
@@ -1,10 +1,18 @@
 from __future__ import annotations
 
-from collections import defaultdict
+import hashlib
+import heapq
+import math
+from collections import defaultdict, deque
 from dataclasses import dataclass, field
 from enum import Enum, auto
+from functools import cached_property
+from pathlib import Path
 from random import Random
-from typing import Iterable, MutableMapping, NewType, TypeVar
+from time import perf_counter
+from typing import Callable, Iterable, Iterator, MutableMapping, NewType, TypeVar
+
+import numpy as np
 
 
 class Direction(Enum):
@@ -32,13 +40,23 @@ class PossibleNeighbors:
     )
 
 
+# (deltax, deltay), with y growing downwards like the rows of a map
 compass = (
-    (Direction.north, (0, 1)),
+    (Direction.north, (0, -1)),
     (Direction.east, (1, 0)),
-    (Direction.south, (0, -1)),
+    (Direction.south, (0, 1)),
     (Direction.west, (-1, 0)),
 )
 
+direction_index = {direction: index for index, (direction, _) in enumerate(compass)}
+
+opposite = {
+    Direction.north: Direction.south,
+    Direction.east: Direction.west,
+    Direction.south: Direction.north,
+    Direction.west: Direction.east,
+}
+
 
 def in_bounds(targetx: int, targety: int, h: int, w: int) -> bool:
     return (targetx >= 0) and (targetx < w) and (targety >= 0) and (targety < h)
@@ -57,6 +75,22 @@ def adjacents(
             yield (direction, grid[targetx][targety])
 
 
+def overlap(
+    deltax: int, deltay: int, h: int, w: int
+) -> tuple[tuple[slice, slice], tuple[slice, slice]]:
+    # [y, x] slices pairing every cell that has a neighbour at (deltax, deltay)
+    # with that neighbour
+    here = (
+        slice(max(0, -deltay), h - max(0, deltay)),
+        slice(max(0, -deltax), w - max(0, deltax)),
+    )
+    there = (
+        slice(max(0, deltay), h + min(0, deltay)),
+        slice(max(0, deltax), w + min(0, deltax)),
+    )
+    return here, there
+
+
 def weighted_choice(r: Random, x: Iterable[tuple[T, int]]) -> T:
     return r.choices(
         [each for each, weight in x], weights=[weight for each, weight in x]
@@ -76,38 +110,37 @@ class GeneratingTile:
         h: int,
         w: int,
         in_progress: GeneratingMap,
-        trained: TrainedSet,
+        model: CompiledSet,
     ) -> None:
+        index = model.index
         if self.remaining is None:
-            self.remaining = set(trained.keys())
-        probabilities = {each: 1 for each in self.remaining}
+            self.remaining = set(model.tile_ids)
+        # in id order, so the choice can't depend on how the set was filled
+        probabilities = {each: 1 for each in sorted(self.remaining)}
         for direction, other_generating_tile in adjacents(x, y, h, w, in_progress):
-            reversed = {
-                Direction.north: Direction.south,
-                Direction.east: Direction.west,
-                Direction.south: Direction.north,
-                Direction.west: Direction.east,
-            }[direction]
-            for remaining_tile_id in other_generating_tile.remaining or set(
-                trained.keys()
-            ):
-                neighbors = trained[remaining_tile_id]
-                id_to_chance_for_us = neighbors.possibilities[reversed]
+            reversed = direction_index[opposite[direction]]
+            for remaining_tile_id in other_generating_tile.remaining or model.tile_ids:
+                id_to_chance_for_us = model.counts[reversed, index[remaining_tile_id]]
                 probabilities = {
-                    tile_id: (score + id_to_chance_for_us[tile_id].chance)
+                    tile_id: (score + int(id_to_chance_for_us[index[tile_id]]))
                     for (tile_id, score) in probabilities.items()
-                    if tile_id in id_to_chance_for_us
+                    if id_to_chance_for_us[index[tile_id]]
                 }
 
         chosen = weighted_choice(r, probabilities.items())
         self.remaining = set([chosen])
 
         for direction, other_generating_tile in adjacents(x, y, h, w, in_progress):
-            other_generating_tile.remaining = (
-                other_generating_tile.remaining
-                if other_generating_tile.remaining is not None
-                else set(trained.keys())
-            ) & set(trained[chosen].possibilities[direction])
+            allowed = model.compatible[direction_index[direction], index[chosen]]
+            other_generating_tile.remaining = {
+                tile_id
+                for tile_id in (
+                    other_generating_tile.remaining
+                    if other_generating_tile.remaining is not None
+                    else model.tile_ids
+                )
+                if allowed[index[tile_id]]
+            }
 
 
 GeneratingMap = list[list[GeneratingTile]]
@@ -124,9 +157,967 @@ def train_on_map(training: list[list[TileId]]) -> TrainedSet:
     height = len(training)
     width = len(training[0])
     id_to_tile: defaultdict[TileId, PossibleNeighbors] = IdToTileMap()
-    for x, row in enumerate(training):
+    for row in training:
         assert len(row) == width, "uniform widths required"
-        for y, cell in enumerate(row):
-            for direction, adjacent in adjacents(x, y, height, width, training):
+    # training is a list of rows, adjacents wants grid[x][y]
+    columns = [list(column) for column in zip(*training)]
+    for y, row in enumerate(training):
+        for x, cell in enumerate(row):
+            for direction, adjacent in adjacents(x, y, height, width, columns):
+                if cell not in id_to_tile:
+                    id_to_tile[cell] = PossibleNeighbors(cell)
                 id_to_tile[cell].possibilities[direction][adjacent].chance += 1
     return id_to_tile
+
+
+class Contradiction(Exception):
+    pass
+
+
+@dataclass
+class Histogram:
+    buckets: list[int] = field(default_factory=lambda: [0] * 32)
+    # buckets[i]: durations of at least 2**(i - 1) and under 2**i microseconds
+    count: int = 0
+    total: float = 0.0
+    longest: float = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.buckets[min(int(seconds * 1e6).bit_length(), 31)] += 1
+        self.count += 1
+        self.total += seconds
+        self.longest = max(self.longest, seconds)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+@dataclass
+class Stats:
+    # opt-in instrumentation: hand one to a Solver (or Propagator) to have it
+    # counted; with none, each hook costs a single None check
+    counts: defaultdict[str, int] = field(default_factory=lambda: defaultdict(int))
+    peaks: defaultdict[str, int] = field(default_factory=lambda: defaultdict(int))
+    timings: defaultdict[str, Histogram] = field(
+        default_factory=lambda: defaultdict(Histogram)
+    )
+
+    def time(self, phase: str, started: float) -> float:
+        # record the time since started against phase; returns now, to start
+        # timing the next phase from
+        now = perf_counter()
+        self.timings[phase].add(now - started)
+        return now
+
+    def peak(self, name: str, value: int) -> None:
+        if value > self.peaks[name]:
+            self.peaks[name] = value
+
+    def as_dict(self) -> dict[str, object]:
+        return {
+            "counts": dict(self.counts),
+            "peaks": dict(self.peaks),
+            "timings": {
+                phase: {
+                    "count": each.count,
+                    "total": each.total,
+                    "mean": each.mean,
+                    "longest": each.longest,
+                    "buckets": each.buckets,
+                }
+                for phase, each in self.timings.items()
+            },
+        }
+
+    def lines(self) -> list[str]:
+        # short enough to overlay on the viewer
+        return [
+            "  ".join(f"{name} {count}" for name, count in sorted(self.counts.items())),
+            "  ".join(
+                f"{phase} {each.mean * 1000:.2f}ms"
+                for phase, each in sorted(self.timings.items())
+            ),
+        ]
+
+
+class Stopped(Exception):
+    pass
+
+
+@dataclass(frozen=True, eq=False)
+class CompiledSet:
+    tile_ids: tuple[TileId, ...]
+    # tile ids by their compact index 0..T-1, which is what the arrays use
+    counts: np.ndarray
+    # counts[d, a, b]: times tile b was seen in compass direction d of tile a
+    weights: np.ndarray
+    # how often each tile was seen, normalised to add up to 1
+    compatible: np.ndarray = field(init=False)
+    # compatible[d, a, b]: tile b may sit in compass direction d of tile a
+
+    def __post_init__(self) -> None:
+        # a view, so counts living in shared memory are not copied
+        counts = np.asarray(self.counts, dtype=np.uint32).view()
+        weights = np.array(self.weights, dtype=np.float64)
+        weights /= weights.sum()
+        compatible = counts > 0
+        for name, array in (
+            ("counts", counts),
+            ("weights", weights),
+            ("compatible", compatible),
+        ):
+            array.setflags(write=False)
+            object.__setattr__(self, name, array)
+
+    def save(self, path: str | Path) -> None:
+        with open(path, "wb") as file_pointer:
+            np.savez(
+                file_pointer,
+                tile_ids=np.asarray(self.tile_ids, dtype=np.int64),
+                counts=self.counts,
+                weights=self.weights,
+            )
+
+    @classmethod
+    def load(cls, path: str | Path) -> CompiledSet:
+        with np.load(path) as saved:
+            return cls(
+                tuple(TileId(int(each)) for each in saved["tile_ids"]),
+                saved["counts"],
+                saved["weights"],
+            )
+
+    @cached_property
+    def index(self) -> dict[TileId, int]:
+        return {tile_id: i for i, tile_id in enumerate(self.tile_ids)}
+
+    @cached_property
+    def digest(self) -> str:
+        # identifies the model by its contents, e.g. to key cached results on
+        digest = hashlib.sha256()
+        for array in (np.asarray(self.tile_ids, dtype=np.int64), self.counts):
+            digest.update(np.ascontiguousarray(array).tobytes())
+        digest.update(self.weights.tobytes())
+        return digest.hexdigest()
+
+    @cached_property
+    def weight_logs(self) -> np.ndarray:
+        weights = self.weights
+        return weights * np.log(weights, where=weights > 0, out=np.zeros_like(weights))
+
+
+def compile_trained(trained: TrainedSet) -> CompiledSet:
+    # only reads trained: indexing its nested defaultdicts would grow them
+    tile_ids = tuple(sorted(trained.keys()))
+    index = {tile_id: i for i, tile_id in enumerate(tile_ids)}
+    counts = np.zeros((len(compass), len(tile_ids), len(tile_ids)), dtype=np.uint32)
+    for tile_id, neighbors in trained.items():
+        for direction, chances in neighbors.possibilities.items():
+            for other, chance in chances.items():
+                if other in index:
+                    counts[
+                        direction_index[direction], index[tile_id], index[other]
+                    ] = chance.chance
+    return CompiledSet(tile_ids, counts, counts.sum(axis=(0, 2)))
+
+
+def load_tile_map(path: str = "data/zelda_overworld_map.txt") -> np.ndarray:
+    with open(path, "r") as file_pointer:
+        return decode_tile_map(file_pointer.read())
+
+
+def decode_tile_map(text: str) -> np.ndarray:
+    # the same two digit hex text as wfc_render.parse_tile_map reads, but
+    # decoded in one go; bytes.fromhex skips the spaces and newlines
+    rows = sum(1 for row in text.splitlines() if row.strip())
+    return np.frombuffer(bytes.fromhex(text), dtype=np.uint8).reshape(rows, -1)
+
+
+def encode_tile_map(tiles: np.ndarray) -> str:
+    # the reverse of decode_tile_map, byte for byte: lower case hex pairs,
+    # space separated, one row to a line
+    if tiles.size and (tiles.min() < 0 or tiles.max() > 255):
+        raise ValueError("the hex text format only holds tile ids 0 to 255")
+    return "".join(" ".join(row) + "\n" for row in np.char.mod("%02x", tiles).tolist())
+
+
+def train_on_array(training: np.ndarray, prune: bool = False) -> CompiledSet:
+    # the same counts as compile_trained(train_on_map(...)), made with one
+    # bincount per direction over the shifted map instead of a Python loop;
+    # prune runs the result through pruned()
+    assert training.ndim == 2 and training.size, "training data"
+    seen = np.bincount(training.ravel()) > 0
+    tile_ids = np.flatnonzero(seen)
+    compact = (np.cumsum(seen) - 1)[training]
+    count = len(tile_ids)
+    h, w = training.shape
+    counts = np.zeros((len(compass), count, count), dtype=np.uint32)
+    for d, (_, (deltax, deltay)) in enumerate(compass):
+        here, there = overlap(deltax, deltay, h, w)
+        pairs = compact[here] * count + compact[there]
+        counts[d] = np.bincount(pairs.ravel(), minlength=count * count).reshape(
+            count, count
+        )
+    model = CompiledSet(
+        tuple(TileId(int(each)) for each in tile_ids),
+        counts,
+        counts.sum(axis=(0, 2)),
+    )
+    return pruned(model) if prune else model
+
+
+def pruned(model: CompiledSet) -> CompiledSet:
+    # arc consistency on the model itself: drop tiles never seen, then keep
+    # dropping tiles left without a possible neighbour in some direction (such
+    # as ones only ever seen along an edge of the training map) until none are
+    # left; whatever remains can sit anywhere inside a map
+    alive = model.weights > 0
+    while True:
+        supported = alive & (model.compatible & alive).any(axis=2).all(axis=0)
+        if (supported == alive).all():
+            break
+        alive = supported
+    if alive.all():
+        return model
+    if not alive.any():
+        raise ValueError("no tile in the model can sit inside a map")
+    keep = np.flatnonzero(alive)
+    return CompiledSet(
+        tuple(model.tile_ids[i] for i in keep),
+        model.counts[:, keep][:, :, keep],
+        model.weights[keep],
+    )
+
+
+@dataclass(frozen=True, eq=False)
+class TileClasses:
+    model: CompiledSet
+    compressed: CompiledSet
+    # one tile per class, named after its first member; solve over this
+    classes: np.ndarray
+    # classes[i]: the class of model.tile_ids[i], an index into compressed
+
+    def narrow(self, tiles: np.ndarray) -> np.ndarray:
+        # tile ids of model to the ids of their classes, -1s left alone
+        names = np.asarray(self.compressed.tile_ids)[self.classes]
+        lookup = dict(zip(self.model.tile_ids, names.tolist()))
+        return np.vectorize(lambda each: lookup.get(each, each), otypes=[np.int64])(
+            tiles
+        )
+
+    def expand(
+        self, tiles: np.ndarray, r: Random, constraints: np.ndarray | None = None
+    ) -> np.ndarray:
+        # pick a member of each cell's class by weight; the members of a class
+        # allow exactly the same neighbours, so any picks stay consistent.
+        # Cells fixed in constraints keep their tile.
+        rng = np.random.default_rng(r.getrandbits(64))
+        result = np.array(tiles, dtype=np.int64)
+        ids = np.asarray(self.model.tile_ids)
+        for c, name in enumerate(self.compressed.tile_ids):
+            members = np.flatnonzero(self.classes == c)
+            if len(members) < 2:
+                continue
+            cells = tiles == name
+            weights = self.model.weights[members]
+            result[cells] = rng.choice(
+                ids[members], size=int(cells.sum()), p=weights / weights.sum()
+            )
+        if constraints is not None:
+            fixed = constraints >= 0
+            result[fixed] = constraints[fixed]
+        return result
+
+    def generate(
+        self,
+        h: int,
+        w: int,
+        r: Random,
+        constraints: np.ndarray | None = None,
+        **options: object,
+    ) -> np.ndarray:
+        # options are passed on to Solver
+        narrowed = None if constraints is None else self.narrow(constraints)
+        tiles = Solver(
+            self.compressed, h, w, r, constraints=narrowed, **options
+        ).solve()
+        return self.expand(tiles, r, constraints)
+
+
+def compress(model: CompiledSet) -> TileClasses:
+    # group tiles whose compatibility with every other tile, both ways round
+    # and in every direction, is identical; the wave then needs one entry per
+    # group rather than per tile
+    count = len(model.tile_ids)
+    compatible = model.compatible
+    signatures = np.concatenate(
+        (
+            compatible.transpose(1, 0, 2).reshape(count, -1),
+            compatible.transpose(2, 0, 1).reshape(count, -1),
+        ),
+        axis=1,
+    )
+    first: dict[bytes, int] = {}
+    classes = np.array(
+        [first.setdefault(row.tobytes(), len(first)) for row in signatures]
+    )
+    # membership[i, c]: tile i is in class c
+    membership = np.zeros((count, len(first)), dtype=np.uint64)
+    membership[np.arange(count), classes] = 1
+    counts = membership.T @ model.counts.astype(np.uint64) @ membership
+    names = [model.tile_ids[int(np.argmax(classes == c))] for c in range(len(first))]
+    compressed = CompiledSet(tuple(names), counts, membership.T @ model.weights)
+    return TileClasses(model, compressed, classes)
+
+
+@dataclass
+class Wave:
+    model: CompiledSet
+    possible: np.ndarray
+    # possible[y, x, i]: model.tile_ids[i] is still allowed at (x, y)
+    counts: np.ndarray = field(init=False)
+    totals: np.ndarray = field(init=False)
+    weight_logs: np.ndarray = field(init=False)
+    # per cell running sums over the tiles still possible there: how many,
+    # their weights, and weight * log(weight), kept up to date by remove()
+
+    def __post_init__(self) -> None:
+        self.recount()
+
+    @classmethod
+    def empty(cls, model: CompiledSet, h: int, w: int) -> Wave:
+        return cls(model, np.ones((h, w, len(model.tile_ids)), dtype=bool))
+
+    @property
+    def h(self) -> int:
+        return self.possible.shape[0]
+
+    @property
+    def w(self) -> int:
+        return self.possible.shape[1]
+
+    def neighbors(self, x: int, y: int) -> Iterable[tuple[int, int, int]]:
+        for d, (_, (deltax, deltay)) in enumerate(compass):
+            targetx = x + deltax
+            targety = y + deltay
+            if in_bounds(targetx, targety, self.h, self.w):
+                yield (d, targetx, targety)
+
+    def recount(self) -> None:
+        self.counts = self.possible.sum(axis=2)
+        self.totals = self.possible @ self.model.weights
+        self.weight_logs = self.possible @ self.model.weight_logs
+
+    def remove(self, x: int, y: int, banned: np.ndarray) -> None:
+        # banned must only hold tiles that are still possible at (x, y)
+        self.possible[y, x] &= ~banned
+        self.counts[y, x] -= banned.sum()
+        self.totals[y, x] -= banned @ self.model.weights
+        self.weight_logs[y, x] -= banned @ self.model.weight_logs
+
+    def restore(self, x: int, y: int, banned: np.ndarray) -> None:
+        # the reverse of remove()
+        self.possible[y, x] |= banned
+        self.counts[y, x] += banned.sum()
+        self.totals[y, x] += banned @ self.model.weights
+        self.weight_logs[y, x] += banned @ self.model.weight_logs
+
+    def remaining(self, x: int, y: int) -> list[TileId]:
+        return [self.model.tile_ids[i] for i in np.flatnonzero(self.possible[y, x])]
+
+    def choose(self, r: Random, x: int, y: int) -> int:
+        options = np.flatnonzero(self.possible[y, x])
+        if not len(options):
+            raise Contradiction(x, y)
+        return weighted_choice(
+            r, list(zip(options.tolist(), self.model.weights[options].tolist()))
+        )
+
+    def entropy(self, x: int, y: int) -> float:
+        total = self.totals[y, x]
+        return math.log(total) - self.weight_logs[y, x] / total
+
+    def entropies(self) -> np.ndarray:
+        # Shannon entropy of every cell, weighting tiles by how often they
+        # were seen in training
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.log(self.totals) - self.weight_logs / self.totals
+
+    def tiles(self) -> np.ndarray:
+        # tile id per cell, -1 where the cell is not yet collapsed
+        ids = np.asarray(self.model.tile_ids)
+        result = ids[self.possible.argmax(axis=2)]
+        result[self.counts != 1] = -1
+        return result
+
+
+@dataclass
+class Scheduler:
+    wave: Wave
+    r: Random
+    heap: list[tuple[float, int, int, int]] = field(default_factory=list)
+    # (entropy plus a little noise, stamp, x, y); entries whose stamp is out of
+    # date are skipped when they surface instead of being removed eagerly
+
+    def __post_init__(self) -> None:
+        self.stamps = np.zeros((self.wave.h, self.wave.w), dtype=np.int64)
+        undecided = self.wave.counts > 1
+        entropies = self.wave.entropies()
+        for y, x in zip(*np.nonzero(undecided)):
+            self.heap.append((entropies[y, x] + self.noise(), 0, int(x), int(y)))
+        heapq.heapify(self.heap)
+
+    def noise(self) -> float:
+        return self.r.random() * 1e-6
+
+    def touch(self, x: int, y: int) -> None:
+        self.stamps[y, x] += 1
+        if self.wave.counts[y, x] > 1:
+            heapq.heappush(
+                self.heap,
+                (
+                    self.wave.entropy(x, y) + self.noise(),
+                    int(self.stamps[y, x]),
+                    x,
+                    y,
+                ),
+            )
+
+    def pick(self) -> tuple[int, int] | None:
+        while self.heap:
+            _, stamp, x, y = heapq.heappop(self.heap)
+            if stamp == self.stamps[y, x] and self.wave.counts[y, x] > 1:
+                return (x, y)
+        return None
+
+
+@dataclass
+class Connectivity:
+    # a global constraint: the required (x, y) cells have to be passable and
+    # joined by paths of passable cells, as does every cell that collapses to
+    # a passable tile if everything is set. Paths are judged optimistically,
+    # through any cell that could still be passable, so only a cell losing
+    # its last passable tile can break one; the union-find over cells already
+    # collapsed to passable tiles tells once the required cells are joined
+    # for certain, after which there is nothing left to check for them
+    passable: np.ndarray
+    # passable[i]: model.tile_ids[i] can be walked over
+    required: list[tuple[int, int]] = field(default_factory=list)
+    everything: bool = False
+
+    @classmethod
+    def from_solidity(
+        cls, model: CompiledSet, solidity: list[int], **options: object
+    ) -> Connectivity:
+        # e.g. wfc_headless.TILE_SOLIDITY, which is by tile id
+        passable = np.array([not solidity[each] for each in model.tile_ids])
+        return cls(passable, **options)  # type: ignore[arg-type]
+
+    def attach(self, wave: Wave) -> None:
+        # start tracking wave, e.g. a Solver's after every reset
+        self.wave = wave
+        self.stale = True
+        self.blocked: list[tuple[int, int]] = []
+        # cells that lost their last passable tile since the last check
+        self.walked: list[tuple[int, int]] = []
+        # cells collapsed to a passable tile since the last check
+
+    def rebuild(self) -> None:
+        wave = self.wave
+        self.maybe = (wave.possible & self.passable).any(axis=2)
+        self.joined = self.maybe & (wave.counts == 1)
+        # collapsed to a passable tile
+        self.parent: list[int] | None = None
+        # union-find over the joined cells, by y * w + x; only built when
+        # there are required cells to look up in it
+        self.component: np.ndarray | None = None
+        # cells that could still be reached from the anchor, when known
+        self.done = False
+        self.blocked.clear()
+        self.walked.clear()
+        self.stale = False
+
+    def roots(self) -> set[int]:
+        w = self.wave.w
+        if self.parent is None:
+            self.parent = list(range(self.wave.h * w))
+            joined = self.joined
+            for y, x in np.argwhere(joined[:, :-1] & joined[:, 1:]).tolist():
+                self.union(y * w + x, y * w + x + 1)
+            for y, x in np.argwhere(joined[:-1] & joined[1:]).tolist():
+                self.union(y * w + x, (y + 1) * w + x)
+        return {self.find(y * w + x) for x, y in self.required}
+
+    def find(self, cell: int) -> int:
+        parent = self.parent
+        assert parent is not None
+        while parent[cell] != cell:
+            parent[cell] = parent[parent[cell]]
+            cell = parent[cell]
+        return cell
+
+    def union(self, cell: int, other: int) -> None:
+        assert self.parent is not None
+        self.parent[self.find(other)] = self.find(cell)
+
+    def join(self, x: int, y: int) -> None:
+        self.joined[y, x] = True
+        if self.parent is None:
+            return
+        w = self.wave.w
+        for _, targetx, targety in self.wave.neighbors(x, y):
+            if self.joined[targety, targetx]:
+                self.union(y * w + x, targety * w + targetx)
+
+    def banned(self, x: int, y: int) -> None:
+        # from Propagator.ban, once (x, y) has lost some tiles
+        if self.stale or not self.maybe[y, x]:
+            return
+        if not (self.wave.possible[y, x] & self.passable).any():
+            self.maybe[y, x] = False
+            self.blocked.append((x, y))
+        elif self.wave.counts[y, x] == 1:
+            self.walked.append((x, y))
+
+    def check(self) -> None:
+        # from Propagator.propagate, once the wave has settled
+        if self.stale:
+            self.rebuild()
+        for x, y in self.walked:
+            self.join(x, y)
+        walked, self.walked = self.walked, []
+        blocked, self.blocked = self.blocked, []
+        if not self.done and self.required:
+            self.done = len(self.roots()) == 1 and all(
+                self.joined[y, x] for x, y in self.required
+            )
+        if self.done and not self.everything:
+            return
+        component = self.component
+        if component is not None:
+            # block the cells one at a time, as two blocked together (across a
+            # corridor, say) can split what neither would on its own
+            for x, y in blocked:
+                self.maybe[y, x] = True
+            for x, y in blocked:
+                self.maybe[y, x] = False
+                if component is not None and component[y, x]:
+                    component[y, x] = False
+                    if not self.locally_joined(x, y):
+                        component = None
+        if component is None:
+            component = self.component = self.reach()
+            if component is None:
+                return
+            walked = (
+                np.argwhere(self.joined)[:, ::-1].tolist() if self.everything else []
+            )
+            if not all(component[y, x] for x, y in self.required):
+                raise Contradiction("required cells cut off")
+        if self.everything and not all(component[y, x] for x, y in walked):
+            raise Contradiction("passable cells cut off")
+
+    def locally_joined(self, x: int, y: int) -> bool:
+        # whether the passable neighbours of the newly blocked (x, y) still
+        # join up around it, through the eight cells surrounding it; if so,
+        # blocking it cannot have split anything
+        ring = [
+            0 <= x + deltax < self.wave.w
+            and 0 <= y + deltay < self.wave.h
+            and bool(self.maybe[y + deltay, x + deltax])
+            for deltax, deltay in (
+                (-1, -1),
+                (0, -1),
+                (1, -1),
+                (1, 0),
+                (1, 1),
+                (0, 1),
+                (-1, 1),
+                (-1, 0),
+            )
+        ]
+        # odd positions are the four neighbours; count the runs of passable
+        # ring cells that hold one, going round from a gap
+        if all(ring):
+            return True
+        start = ring.index(False)
+        runs = 0
+        holds = False
+        for i in range(start + 1, start + 9):
+            if ring[i % 8]:
+                holds = holds or i % 2 == 1
+            else:
+                runs += holds
+                holds = False
+        return runs <= 1
+
+    def reach(self) -> np.ndarray | None:
+        # every cell that could still be reached from the first required cell
+        # (or from any collapsed passable one); None while there is neither
+        if self.required:
+            x, y = self.required[0]
+        elif self.joined.any():
+            y, x = np.argwhere(self.joined)[0].tolist()
+        else:
+            return None
+        h, w = self.wave.h, self.wave.w
+        maybe = self.maybe.ravel().tolist()
+        seen = bytearray(h * w)
+        if maybe[y * w + x]:
+            seen[y * w + x] = 1
+            queue = [y * w + x]
+            while queue:
+                cell = queue.pop()
+                cellx = cell % w
+                for other, inside in (
+                    (cell - w, cell >= w),
+                    (cell + w, cell < (h - 1) * w),
+                    (cell - 1, cellx > 0),
+                    (cell + 1, cellx < w - 1),
+                ):
+                    if inside and maybe[other] and not seen[other]:
+                        seen[other] = 1
+                        queue.append(other)
+        return np.frombuffer(bytes(seen), dtype=bool).reshape(h, w).copy()
+
+
+@dataclass
+class Propagator:
+    wave: Wave
+    scheduler: Scheduler | None = None
+    trail: list[tuple[int, int, np.ndarray]] | None = None
+    # when set, every ban is recorded here so that undo() can take it back
+    touched: list[tuple[int, int]] | None = None
+    # when set, every cell a ban or an undo changes is appended here
+    stats: Stats | None = None
+    connectivity: Connectivity | None = None
+    # when set, checked every time propagation settles
+    support: np.ndarray = field(init=False)
+    # support[y, x, i, d]: how many tiles still possible in direction d of (x, y)
+    # allow tile i at (x, y); i is banned once any direction runs out
+    pending: dict[tuple[int, int], np.ndarray] = field(default_factory=dict)
+    worklist: deque[tuple[int, int]] = field(default_factory=deque)
+
+    def __post_init__(self) -> None:
+        compatible = self.wave.model.compatible
+        # rows of columns[d] are the columns of links[d]: gathering a few is
+        # quickest when dropping a few tiles, BLAS on links when dropping many
+        self.columns = np.ascontiguousarray(compatible.transpose(0, 2, 1), np.int16)
+        self.links = compatible.astype(np.float32)
+        self.backwards = [direction_index[opposite[each]] for each, _ in compass]
+        self.settle()
+        if self.connectivity is not None:
+            self.connectivity.attach(self.wave)
+
+    def settle(self) -> None:
+        # recount every support from scratch, dropping unsupported tiles until
+        # nothing changes; used to start off and after bulk edits to the wave
+        possible = self.wave.possible
+        h, w, count = possible.shape
+        assert count < 2**15, "too many tiles for int16 support counts"
+        while True:
+            # edges have nothing to run out of
+            support = np.full((h, w, count, len(compass)), count + 1, dtype=np.int16)
+            for d, (_, (deltax, deltay)) in enumerate(compass):
+                here, there = overlap(deltax, deltay, h, w)
+                support[here + (slice(None), d)] = possible[there] @ self.links[d].T
+            unsupported = possible & (support <= 0).any(axis=3)
+            if not unsupported.any():
+                break
+            possible &= ~unsupported
+        self.wave.recount()
+        self.support = support
+        self.pending.clear()
+        self.worklist.clear()
+        empty = np.argwhere(~possible.any(axis=2))
+        if len(empty):
+            y, x = empty[0]
+            raise Contradiction(int(x), int(y))
+
+    def ban(self, x: int, y: int, banned: np.ndarray) -> None:
+        banned = banned & self.wave.possible[y, x]
+        if not banned.any():
+            return
+        lost_support = self.support_of(banned)
+        self.wave.remove(x, y, banned)
+        if self.trail is not None:
+            self.trail.append((x, y, banned))
+        if self.scheduler is not None:
+            self.scheduler.touch(x, y)
+        if self.touched is not None:
+            self.touched.append((x, y))
+        if self.stats is not None:
+            self.stats.counts["bans"] += 1
+        if self.connectivity is not None:
+            self.connectivity.banned(x, y)
+        for d, targetx, targety in self.wave.neighbors(x, y):
+            # we are in the opposite direction, as seen from the neighbour
+            back = self.backwards[d]
+            counts = self.support[targety, targetx, :, back]
+            counts -= lost_support[back]
+            lost = self.wave.possible[targety, targetx] & (counts <= 0)
+            if lost.any():
+                target = (targetx, targety)
+                if target in self.pending:
+                    self.pending[target] |= lost
+                else:
+                    self.pending[target] = lost
+                    self.worklist.append(target)
+                    if self.stats is not None:
+                        self.stats.peak("queue", len(self.worklist))
+        if not self.wave.counts[y, x]:
+            raise Contradiction(x, y)
+
+    def support_of(self, tiles: np.ndarray) -> np.ndarray:
+        # support[d, i]: how many of tiles allow tile i in direction d of them
+        indexes = np.flatnonzero(tiles)
+        if len(indexes) * 8 < len(tiles):
+            return self.columns[:, indexes].sum(axis=1, dtype=np.int16)
+        return (self.links @ tiles.astype(np.float32)).astype(np.int16)
+
+    def propagate(self) -> None:
+        try:
+            while self.worklist:
+                x, y = self.worklist.popleft()
+                self.ban(x, y, self.pending.pop((x, y)))
+            if self.connectivity is not None:
+                self.connectivity.check()
+        except Contradiction:
+            self.pending.clear()
+            self.worklist.clear()
+            raise
+
+    def undo(self, mark: int) -> None:
+        # take back every ban recorded since the trail was mark entries long
+        assert self.trail is not None, "undo needs a trail"
+        while len(self.trail) > mark:
+            x, y, banned = self.trail.pop()
+            self.wave.restore(x, y, banned)
+            lost_support = self.support_of(banned)
+            for d, targetx, targety in self.wave.neighbors(x, y):
+                back = self.backwards[d]
+                self.support[targety, targetx, :, back] += lost_support[back]
+            if self.scheduler is not None:
+                self.scheduler.touch(x, y)
+            if self.touched is not None:
+                self.touched.append((x, y))
+        if self.connectivity is not None:
+            self.connectivity.stale = True
+        self.pending.clear()
+        self.worklist.clear()
+
+    def collapse(self, x: int, y: int, index: int) -> None:
+        banned = np.ones_like(self.wave.possible[y, x])
+        banned[index] = False
+        self.ban(x, y, banned)
+        self.propagate()
+
+    def observe(self, r: Random, x: int, y: int) -> TileId:
+        chosen = self.wave.choose(r, x, y)
+        self.collapse(x, y, chosen)
+        return self.wave.model.tile_ids[chosen]
+
+
+@dataclass(frozen=True)
+class Collapsed:
+    x: int
+    y: int
+    tile_id: TileId
+
+
+@dataclass(frozen=True)
+class DomainChanged:
+    x: int
+    y: int
+    remaining: int
+    # how many tiles are still possible there, never 1
+
+
+@dataclass(frozen=True)
+class Backtracked:
+    decisions: int
+    # how many decisions were unwound
+
+
+@dataclass(frozen=True)
+class Restarted:
+    restarts: int
+
+
+SolveEvent = Collapsed | DomainChanged | Backtracked | Restarted
+
+
+@dataclass
+class Solver:
+    model: CompiledSet
+    h: int
+    w: int
+    r: Random
+    max_depth: int = 256
+    # how many of the latest decisions a contradiction may unwind; older ones
+    # are final
+    max_backtracks: int = 1024
+    # per attempt, before the attempt is abandoned and the wave starts over
+    max_restarts: int = 8
+    constraints: np.ndarray | None = None
+    # (h, w) tile ids that cells are fixed to up front, -1 where a cell is free
+    should_stop: Callable[[], bool] | None = None
+    # polled before every decision; solve() raises Stopped once it says so
+    stats: Stats | None = None
+    connectivity: Connectivity | None = None
+    # a global constraint on which cells can reach each other
+    backtracks: int = 0
+    restarts: int = 0
+
+    def __post_init__(self) -> None:
+        self.initial = Wave.empty(self.model, self.h, self.w)
+        propagator = Propagator(self.initial, connectivity=self.connectivity)
+        if self.connectivity is not None:
+            impassable = ~self.connectivity.passable
+            for x, y in self.connectivity.required:
+                propagator.ban(x, y, impassable)
+            propagator.propagate()
+        if self.constraints is not None:
+            assert self.constraints.shape == (self.h, self.w), "constraint shape"
+            for y, x in np.argwhere(self.constraints >= 0).tolist():
+                tile_id = TileId(int(self.constraints[y, x]))
+                if tile_id not in self.model.index:
+                    raise ValueError(
+                        f"tile {tile_id} at ({x}, {y}) is not in the model"
+                    )
+                propagator.collapse(x, y, self.model.index[tile_id])
+        self.reset()
+
+    def reset(self) -> None:
+        self.wave = Wave(self.model, self.initial.possible.copy())
+        self.trail: list[tuple[int, int, np.ndarray]] = []
+        self.propagator = Propagator(
+            self.wave,
+            trail=self.trail,
+            stats=self.stats,
+            connectivity=self.connectivity,
+        )
+        self.propagator.scheduler = self.scheduler = Scheduler(self.wave, self.r)
+        # (trail length before the decision, x, y, chosen tile index)
+        self.decisions: deque[tuple[int, int, int, int]] = deque()
+        self.attempt_backtracks = 0
+
+    def solve(self) -> np.ndarray:
+        while True:
+            try:
+                return self.attempt()
+            except Contradiction as error:
+                self.restart(error)
+
+    def restart(self, error: Contradiction) -> None:
+        # after an attempt failed with error, which is raised again once the
+        # restarts run out
+        if self.restarts >= self.max_restarts:
+            raise error
+        self.restarts += 1
+        if self.stats is not None:
+            self.stats.counts["restarts"] += 1
+        self.reset()
+
+    def events(self) -> Iterator[SolveEvent]:
+        # solve() one decision at a time, yielding what each decision changed;
+        # after Restarted the wave is back to how it started, so consumers
+        # should read all of it again
+        touched: list[tuple[int, int]] = []
+        self.propagator.touched = touched
+        while True:
+            backtracks = self.backtracks
+            try:
+                more = self.step()
+            except Contradiction as error:
+                self.restart(error)
+                touched.clear()
+                self.propagator.touched = touched
+                yield Restarted(self.restarts)
+                continue
+            if self.backtracks != backtracks:
+                yield Backtracked(self.backtracks - backtracks)
+            for x, y in dict.fromkeys(touched):
+                remaining = int(self.wave.counts[y, x])
+                if remaining == 1:
+                    index = int(self.wave.possible[y, x].argmax())
+                    yield Collapsed(x, y, self.model.tile_ids[index])
+                else:
+                    yield DomainChanged(x, y, remaining)
+            touched.clear()
+            if not more:
+                return
+
+    def attempt(self) -> np.ndarray:
+        while self.step():
+            pass
+        return self.wave.tiles()
+
+    def step(self) -> bool:
+        # make and propagate one decision, backtracking if it contradicts;
+        # False once there is nothing left to decide
+        stats = self.stats
+        if stats is not None:
+            started = perf_counter()
+        picked = self.scheduler.pick()
+        if picked is None:
+            return False
+        if self.should_stop is not None and self.should_stop():
+            raise Stopped()
+        x, y = picked
+        index = self.wave.choose(self.r, x, y)
+        self.decisions.append((len(self.trail), x, y, index))
+        if len(self.decisions) > 2 * self.max_depth:
+            self.commit()
+        if stats is not None:
+            stats.counts["decisions"] += 1
+            started = stats.time("select", started)
+        try:
+            self.propagator.collapse(x, y, index)
+        except Contradiction:
+            if stats is not None:
+                stats.counts["contradictions"] += 1
+                started = stats.time("propagate", started)
+            self.backtrack()
+            if stats is not None:
+                stats.time("backtrack", started)
+        else:
+            if stats is not None:
+                stats.time("propagate", started)
+        return True
+
+    def backtrack(self) -> None:
+        # unwind to the latest decision and rule out the tile it chose; if that
+        # contradicts as well, keep unwinding
+        while self.decisions and self.attempt_backtracks < self.max_backtracks:
+            mark, x, y, index = self.decisions.pop()
+            self.propagator.undo(mark)
+            self.backtracks += 1
+            self.attempt_backtracks += 1
+            if self.stats is not None:
+                self.stats.counts["backtracks"] += 1
+            banned = np.zeros_like(self.wave.possible[y, x])
+            banned[index] = True
+            try:
+                self.propagator.ban(x, y, banned)
+                self.propagator.propagate()
+            except Contradiction:
+                continue
+            return
+        raise Contradiction("out of decisions to backtrack over")
+
+    def commit(self) -> None:
+        # forget all but the latest max_depth decisions, along with the part of
+        # the trail only they could have undone
+        while len(self.decisions) > self.max_depth:
+            self.decisions.popleft()
+        cut = self.decisions[0][0] if self.decisions else len(self.trail)
+        del self.trail[:cut]
+        self.decisions = deque(
+            (mark - cut, x, y, index) for mark, x, y, index in self.decisions
+        )
+
+
+def generate(model: CompiledSet, h: int, w: int, r: Random) -> np.ndarray:
+    return Solver(model, h, w, r).solve()
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing.shared_memory import SharedMemory
+from random import Random
+
+import numpy as np
+
+import wfc_parallel
+from wfc_model import CompiledSet, Contradiction, Direction, Solver, compass
+from wfc_parallel import share
+
+# one screen of the overworld; the original map is 16 x 8 of these
+screen_w = 16
+screen_h = 11
+
+Chunk = tuple[int, int]
+
+
+@dataclass
+class World:
+    model: CompiledSet
+    seed: int = 0
+    chunks: dict[Chunk, np.ndarray] = field(default_factory=dict)
+    # (chunkx, chunky) -> (screen_h, screen_w) tile ids; chunk (0, 0) is the
+    # top left screen of the map the world started from
+
+    @classmethod
+    def from_map(
+        cls, model: CompiledSet, tiles: np.ndarray | list[list[int]], seed: int = 0
+    ) -> World:
+        # e.g. wfc_render.parse_tile_map(); every screen of it becomes a
+        # fixed chunk that generated chunks have to fit against
+        tiles = np.asarray(tiles)
+        h, w = tiles.shape
+        assert h % screen_h == 0 and w % screen_w == 0, "whole screens only"
+        world = cls(model, seed)
+        for chunky in range(h // screen_h):
+            for chunkx in range(w // screen_w):
+                world.chunks[(chunkx, chunky)] = tiles[
+                    chunky * screen_h : (chunky + 1) * screen_h,
+                    chunkx * screen_w : (chunkx + 1) * screen_w,
+                ].copy()
+        return world
+
+    def bounds(self) -> tuple[int, int, int, int]:
+        # inclusive (min chunkx, min chunky, max chunkx, max chunky)
+        xs = [chunkx for chunkx, _ in self.chunks]
+        ys = [chunky for _, chunky in self.chunks]
+        return (min(xs), min(ys), max(xs), max(ys))
+
+    def region(self, x: int, y: int, w: int, h: int) -> np.ndarray:
+        # world tiles in the given rectangle, -1 where nothing is known yet
+        result = np.full((h, w), -1, dtype=np.int64)
+        for chunky in range(y // screen_h, (y + h - 1) // screen_h + 1):
+            for chunkx in range(x // screen_w, (x + w - 1) // screen_w + 1):
+                chunk = self.chunks.get((chunkx, chunky))
+                if chunk is None:
+                    continue
+                left = chunkx * screen_w
+                top = chunky * screen_h
+                fromx, tox = max(x, left), min(x + w, left + screen_w)
+                fromy, toy = max(y, top), min(y + h, top + screen_h)
+                result[fromy - y : toy - y, fromx - x : tox - x] = chunk[
+                    fromy - top : toy - top, fromx - left : tox - left
+                ]
+        return result
+
+    def border(self, chunkx: int, chunky: int) -> np.ndarray:
+        # the chunk's window: the screen, all -1, in a ring of what is known
+        return self.region(
+            chunkx * screen_w - 1, chunky * screen_h - 1, screen_w + 2, screen_h + 2
+        )
+
+    def generate(self, chunkx: int, chunky: int) -> np.ndarray:
+        # solve one screen with the ring of known tiles around it as the
+        # only context; raises Contradiction if that ring can't be satisfied,
+        # and ValueError if it has tiles the model doesn't
+        if (chunkx, chunky) in self.chunks:
+            return self.chunks[(chunkx, chunky)]
+        chunk = solve_chunk(
+            self.model, self.seed, chunkx, chunky, self.border(chunkx, chunky)
+        )
+        self.chunks[(chunkx, chunky)] = chunk
+        return chunk
+
+    def extend(self, direction: Direction, count: int = 1) -> list[Chunk]:
+        # add count rows or columns of chunks along one whole edge of the world
+        (_, (deltax, deltay)), *_ = [each for each in compass if each[0] == direction]
+        added = []
+        for _ in range(count):
+            minx, miny, maxx, maxy = self.bounds()
+            if deltax:
+                chunkx = maxx + 1 if deltax > 0 else minx - 1
+                row = [(chunkx, chunky) for chunky in range(miny, maxy + 1)]
+            else:
+                chunky = maxy + 1 if deltay > 0 else miny - 1
+                row = [(chunkx, chunky) for chunkx in range(minx, maxx + 1)]
+            for chunk in row:
+                self.generate(*chunk)
+                added.append(chunk)
+        return added
+
+
+def solve_chunk(
+    model: CompiledSet, seed: int, chunkx: int, chunky: int, window: np.ndarray
+) -> np.ndarray:
+    solver = Solver(
+        model,
+        screen_h + 2,
+        screen_w + 2,
+        # every chunk gets its own stream, so a chunk comes out the same
+        # whatever order the world is explored in
+        Random(f"{seed}/{chunkx}/{chunky}"),
+        constraints=window,
+    )
+    return solver.solve()[1:-1, 1:-1]
+
+
+def _solve_chunk(
+    seed: int, chunkx: int, chunky: int, window: np.ndarray
+) -> np.ndarray | None:
+    # runs in an Outpainter worker, on the model wfc_parallel._attach shared;
+    # None if the border can't be satisfied, or has tiles the model lacks,
+    # as happens with a pruned model and the unpruned map around it
+    assert wfc_parallel._model is not None, "worker not attached"
+    try:
+        return solve_chunk(wfc_parallel._model, seed, chunkx, chunky, window)
+    except (Contradiction, ValueError):
+        return None
+
+
+@dataclass
+class Outpainter:
+    # generates chunks of a World in worker processes, so whatever is drawing
+    # the world never waits on the solver; use it as a context manager, ask
+    # for chunks with request() and pick them up with collect()
+    world: World
+    workers: int = 1
+    running: dict[Chunk, Future[np.ndarray | None]] = field(default_factory=dict)
+    failed: set[Chunk] = field(default_factory=set)
+    # chunks that could not be generated from their border; they are not
+    # asked for again
+    pool: ProcessPoolExecutor | None = None
+    block: SharedMemory | None = None
+
+    def __enter__(self) -> Outpainter:
+        self.block, shared = share(self.world.model)
+        self.pool = ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=wfc_parallel._attach,
+            initargs=(shared,),
+        )
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        assert self.pool is not None and self.block is not None
+        self.pool.shutdown(cancel_futures=True)
+        self.block.close()
+        self.block.unlink()
+
+    def request(self, chunk: Chunk) -> bool:
+        # start generating chunk if there's a free worker; False if it can't
+        # be started yet, so ask again later. Chunks next to one that is still
+        # running wait for it: both would leave the tiles between them open
+        # and could disagree about them
+        if chunk in self.world.chunks or chunk in self.failed:
+            return False
+        if chunk in self.running:
+            return True
+        if len(self.running) >= self.workers:
+            return False
+        chunkx, chunky = chunk
+        for deltay in (-1, 0, 1):
+            for deltax in (-1, 0, 1):
+                if (chunkx + deltax, chunky + deltay) in self.running:
+                    return False
+        assert self.pool is not None, "start the Outpainter with 'with'"
+        self.running[chunk] = self.pool.submit(
+            _solve_chunk, self.world.seed, chunkx, chunky, self.world.border(*chunk)
+        )
+        return True
+
+    def collect(self) -> list[Chunk]:
+        # add whatever the workers have finished to the world, without waiting
+        done = [chunk for chunk, future in self.running.items() if future.done()]
+        added = []
+        for chunk in done:
+            tiles = self.running.pop(chunk).result()
+            if tiles is None:
+                self.failed.add(chunk)
+            else:
+                self.world.chunks[chunk] = tiles
+                added.append(chunk)
+        return added
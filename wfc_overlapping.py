@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from random import Random
+from typing import Any
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from wfc_model import CompiledSet, Solver, TileId, compass, overlap
+
+
+@dataclass(frozen=True, eq=False)
+class OverlappingModel:
+    n: int
+    patterns: np.ndarray
+    # patterns[p]: the (n, n) block of tile ids that pattern p stands for
+    compiled: CompiledSet
+    # the usual tiled model with every "tile id" being a pattern index, so
+    # Wave, Propagator and Solver run on patterns unchanged
+
+
+def row_ids(rows: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # dedup equal rows by sorting a byte view of each row as a single scalar,
+    # which stays vectorised however many rows there are; returns the index of
+    # each unique row's first occurrence, every row's unique id, and counts
+    rows = np.ascontiguousarray(rows)
+    keys = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1])))
+    _, first, ids, counts = np.unique(
+        keys.ravel(), return_index=True, return_inverse=True, return_counts=True
+    )
+    return first, ids.ravel(), counts
+
+
+def train_overlapping(
+    training: np.ndarray, n: int = 2, symmetry: bool = False
+) -> OverlappingModel:
+    # Zelda's tiles only make sense the right way up, so rotated and mirrored
+    # patterns are opt-in; memory for the compiled set grows with patterns²
+    # (727 patterns for n=2 on the overworld, 2882 for n=3)
+    training = np.asarray(training)
+    windows = sliding_window_view(training, (n, n)).reshape(-1, n, n)
+    if symmetry:
+        variants = []
+        for flipped in (windows, windows[:, :, ::-1]):
+            for turns in range(4):
+                variants.append(np.rot90(flipped, turns, axes=(1, 2)))
+        windows = np.concatenate(variants)
+    first, _, counts = row_ids(windows.reshape(len(windows), -1))
+    patterns = windows[first]
+
+    compatible = np.zeros((len(compass), len(patterns), len(patterns)), dtype=bool)
+    for d, (_, (deltax, deltay)) in enumerate(compass):
+        # q may sit at delta from p when the parts of them that overlap agree:
+        # p's cells at there line up with q's cells at here
+        here, there = overlap(deltax, deltay, n, n)
+        ours = patterns[(slice(None),) + there].reshape(len(patterns), -1)
+        theirs = patterns[(slice(None),) + here].reshape(len(patterns), -1)
+        _, ids, _ = row_ids(np.concatenate([ours, theirs]))
+        compatible[d] = ids[: len(patterns), None] == ids[None, len(patterns) :]
+
+    return OverlappingModel(
+        n,
+        patterns,
+        CompiledSet(
+            tuple(TileId(p) for p in range(len(patterns))),
+            compatible.astype(np.uint32),
+            counts,
+        ),
+    )
+
+
+def decode(model: OverlappingModel, grid: np.ndarray) -> np.ndarray:
+    # pattern indexes, one per top left corner, back to tile ids; overlapping
+    # patterns agree where they overlap, so later writes don't change anything
+    h, w = grid.shape
+    tiles = np.empty((h + model.n - 1, w + model.n - 1), dtype=model.patterns.dtype)
+    placed = model.patterns[grid]
+    for y in range(model.n):
+        for x in range(model.n):
+            tiles[y : y + h, x : x + w] = placed[:, :, y, x]
+    return tiles
+
+
+def generate_overlapping(
+    model: OverlappingModel, h: int, w: int, r: Random, **options: Any
+) -> np.ndarray:
+    # an (h, w) map of tile ids; options are passed on to the Solver
+    solver = Solver(model.compiled, h - model.n + 1, w - model.n + 1, r, **options)
+    return decode(model, solver.solve())
@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import os
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing.synchronize import Event
+from random import Random
+from typing import Any, Iterable
+
+import numpy as np
+
+from wfc_model import CompiledSet, Contradiction, Solver, Stopped, TileId
+
+# (x, y, w, h) in output tiles
+Region = tuple[int, int, int, int]
+
+
+@dataclass(frozen=True)
+class SharedModel:
+    # enough to rebuild a CompiledSet on top of counts in shared memory
+    name: str
+    tile_ids: tuple[TileId, ...]
+    shape: tuple[int, ...]
+    weights: tuple[float, ...]
+
+
+def share(model: CompiledSet) -> tuple[SharedMemory, SharedModel]:
+    # the caller owns the block: close() and unlink() it when done
+    block = SharedMemory(create=True, size=model.counts.nbytes)
+    np.ndarray(model.counts.shape, dtype=np.uint32, buffer=block.buf)[:] = model.counts
+    return block, SharedModel(
+        block.name, model.tile_ids, model.counts.shape, tuple(model.weights.tolist())
+    )
+
+
+_block: SharedMemory | None = None
+_model: CompiledSet | None = None
+_stop: Event | None = None
+
+
+def _attach(shared: SharedModel, stop: Event | None = None) -> None:
+    # worker initializer; the block stays mapped for the life of the worker
+    global _block, _model, _stop
+    _stop = stop
+    _block = SharedMemory(name=shared.name)
+    counts = np.ndarray(shared.shape, dtype=np.uint32, buffer=_block.buf)
+    _model = CompiledSet(shared.tile_ids, counts, np.array(shared.weights))
+
+
+def _solve(window: np.ndarray, seed: str) -> np.ndarray | None:
+    # window is the region plus a ring of context; hand back just the region
+    assert _model is not None, "worker not attached"
+    try:
+        h, w = window.shape
+        solver = Solver(_model, h, w, Random(seed), constraints=window)
+        return solver.solve()[1:-1, 1:-1]
+    except Contradiction:
+        return None
+
+
+def spans(
+    total: int, size: int, seam: int
+) -> tuple[list[tuple[int, int]], list[tuple[int, int]]]:
+    # start/stop pairs along one axis: blocks of size with seams between them
+    blocks: list[tuple[int, int]] = []
+    seams: list[tuple[int, int]] = []
+    start = 0
+    while start < total:
+        blocks.append((start, min(start + size, total)))
+        start += size
+        if start < total and seam:
+            seams.append((start, min(start + seam, total)))
+            start += seam
+    return blocks, seams
+
+
+def generate_parallel(
+    model: CompiledSet,
+    h: int,
+    w: int,
+    seed: int = 0,
+    block: tuple[int, int] = (44, 64),
+    seam: int = 2,
+    workers: int | None = None,
+    constraints: np.ndarray | None = None,
+    max_widen: int = 4,
+) -> np.ndarray:
+    # blocks are solved independently, then the vertical seams between them,
+    # then the horizontal seams across the whole width; each stage's pieces
+    # never touch each other, so every stage runs fully in parallel
+    blockh, blockw = block
+    assert seam > 0 or (blockh >= h and blockw >= w), "blocks need seams"
+    xblocks, xseams = spans(w, blockw, seam)
+    yblocks, yseams = spans(h, blockh, seam)
+    # output with a ring of free cells, so every region has a full window
+    fixed = np.full((h + 2, w + 2), -1, dtype=np.int64)
+    if constraints is not None:
+        fixed[1:-1, 1:-1] = constraints
+    canvas = fixed.copy()
+
+    block_shm, shared = share(model)
+    try:
+        with ProcessPoolExecutor(
+            workers or os.cpu_count(), initializer=_attach, initargs=(shared,)
+        ) as pool:
+            stages: list[tuple[str, list[Region], int, int]] = [
+                (
+                    "blocks",
+                    [
+                        (x0, y0, x1 - x0, y1 - y0)
+                        for y0, y1 in yblocks
+                        for x0, x1 in xblocks
+                    ],
+                    0,
+                    0,
+                ),
+                (
+                    "columns",
+                    [
+                        (x0, y0, x1 - x0, y1 - y0)
+                        for y0, y1 in yblocks
+                        for x0, x1 in xseams
+                    ],
+                    (blockw - 2) // 2,
+                    0,
+                ),
+                (
+                    "rows",
+                    [(0, y0, w, y1 - y0) for y0, y1 in yseams],
+                    0,
+                    (blockh - 2) // 2,
+                ),
+            ]
+            for name, regions, widenx, wideny in stages:
+                _run_stage(
+                    pool,
+                    canvas,
+                    fixed,
+                    regions,
+                    f"{seed}/{name}",
+                    widenx,
+                    wideny,
+                    seam,
+                    max_widen,
+                )
+    finally:
+        block_shm.close()
+        block_shm.unlink()
+    return canvas[1:-1, 1:-1]
+
+
+def _run_stage(
+    pool: ProcessPoolExecutor,
+    canvas: np.ndarray,
+    fixed: np.ndarray,
+    regions: list[Region],
+    seed: str,
+    widenx: int,
+    wideny: int,
+    step: int,
+    max_widen: int,
+) -> None:
+    # a region that fails is retried on its own, each time with a new seed and
+    # eating a little further into the already solved tiles either side of it
+    h, w = canvas.shape[0] - 2, canvas.shape[1] - 2
+    running: dict[Future[np.ndarray | None], tuple[int, int, Region]] = {}
+
+    def submit(index: int, attempt: int) -> None:
+        x, y, width, height = regions[index]
+        marginx = min(attempt * step, widenx)
+        marginy = min(attempt * step, wideny)
+        x0, x1 = max(0, x - marginx), min(w, x + width + marginx)
+        y0, y1 = max(0, y - marginy), min(h, y + height + marginy)
+        # forget whatever was solved there before, keep the ring around it
+        canvas[y0 + 1 : y1 + 1, x0 + 1 : x1 + 1] = fixed[
+            y0 + 1 : y1 + 1, x0 + 1 : x1 + 1
+        ]
+        window = canvas[y0 : y1 + 2, x0 : x1 + 2].copy()
+        future = pool.submit(_solve, window, f"{seed}/{index}/{attempt}")
+        running[future] = (index, attempt, (x0, y0, x1 - x0, y1 - y0))
+
+    for index in range(len(regions)):
+        submit(index, 0)
+    while running:
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            index, attempt, (x, y, width, height) = running.pop(future)
+            result = future.result()
+            if result is not None:
+                canvas[y + 1 : y + height + 1, x + 1 : x + width + 1] = result
+            elif attempt >= max_widen:
+                raise Contradiction(f"could not solve {regions[index]}")
+            else:
+                submit(index, attempt + 1)
+
+
+@dataclass
+class Winner:
+    seed: int
+    tiles: np.ndarray
+    # Solver(model, h, w, Random(seed), ...) on its own gives these tiles again
+    failed: list[int] = field(default_factory=list)
+    # seeds that had already contradicted when the winner came in, in order
+
+
+def _attempt(
+    h: int,
+    w: int,
+    seed: int,
+    constraints: np.ndarray | None,
+    options: dict[str, Any],
+) -> np.ndarray | None:
+    assert _model is not None, "worker not attached"
+    stop = _stop
+    try:
+        return Solver(
+            _model,
+            h,
+            w,
+            Random(seed),
+            constraints=constraints,
+            should_stop=stop.is_set if stop is not None else None,
+            **options,
+        ).solve()
+    except (Contradiction, Stopped):
+        return None
+
+
+def solve_portfolio(
+    model: CompiledSet,
+    h: int,
+    w: int,
+    seeds: Iterable[int],
+    workers: int | None = None,
+    constraints: np.ndarray | None = None,
+    **options: Any,
+) -> Winner:
+    # race one independent Solver per seed and keep whichever finishes first;
+    # options go to each Solver, e.g. max_restarts=0 to leave retrying to the
+    # other seeds
+    seeds = list(seeds)
+    stop = multiprocessing.get_context().Event()
+    block, shared = share(model)
+    failed: list[int] = []
+    try:
+        with ProcessPoolExecutor(
+            workers or os.cpu_count(), initializer=_attach, initargs=(shared, stop)
+        ) as pool:
+            running = {
+                pool.submit(_attempt, h, w, seed, constraints, options): seed
+                for seed in seeds
+            }
+            try:
+                while running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    # if several land at once, the earliest seed in the list wins
+                    for future in sorted(
+                        done, key=lambda each: seeds.index(running[each])
+                    ):
+                        seed = running.pop(future)
+                        tiles = future.result()
+                        if tiles is not None:
+                            return Winner(seed, tiles, sorted(failed, key=seeds.index))
+                        failed.append(seed)
+            finally:
+                stop.set()
+                for future in running:
+                    future.cancel()
+    finally:
+        block.close()
+        block.unlink()
+    raise Contradiction(f"every seed failed: {failed}")
@@ -1,22 +1,41 @@
-import itertools
-
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+import time
+from collections import OrderedDict
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from pathlib import Path
+from random import Random
+from typing import Callable, Iterable, Iterator
+
+import numpy as np
 import pygame
 from fritter.boundaries import Cancellable
-from pygame import Surface
+from pygame import Rect, Surface
 from pygame.font import Font
 
-# fmt: off
-TILE_SOLIDITY = [
-    0, 1, 0, 1, 1, 1, 0, 1, 1, 1, 1, 1, 0, 1, 0, 1, 1, 1, 0, 0,
-    0, 1, 1, 1, 0, 1, 0, 1, 1, 1, 1, 1, 0, 1, 1, 1, 0, 1, 0, 0,
-    1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0,
-    1, 1, 1, 1, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 1, 0, 0,
-    1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0,
-    1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0,
-    1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 0, 1, 1, 1, 0, 0, 0, 0, 0,
-    0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 1, 0, 0, 0,
-]
-# fmt: on
+from wfc_cache import cache_root, cached_model
+from wfc_headless import (
+    TILE_SOLIDITY,
+    atlas_columns,
+    atlas_rows,
+    sheet_columns,
+    sheet_tile,
+)
+from wfc_model import (
+    Collapsed,
+    Connectivity,
+    Contradiction,
+    DomainChanged,
+    Restarted,
+    SolveEvent,
+    Solver,
+    Stats,
+)
+from wfc_outpaint import Outpainter, World, screen_h, screen_w
 
 
 def load_font() -> Font:
@@ -25,16 +44,65 @@ def load_font() -> Font:
 
 
 def load_tile_images() -> list[Surface]:
-    tile_images = []
-    for i in range(160):
-        # Load overworld_tile_0.png through overworld_tile_159.png
-        # From the Zelda Walking Tour: https://github.com/asweigart/nes_zelda_map_data
-        img = load_image(f"./data/tiles/overworld_tile_{i}.png")
-        tile_images.append(img)
+    # From the Zelda Walking Tour: https://github.com/asweigart/nes_zelda_map_data
+    tile_images = load_tile_atlas()
     print(f"Loaded {len(tile_images)} tile images")
     return tile_images
 
 
+def load_tile_atlas(
+    size: int = 30,
+    path: str = "data/zelda_overworld_tiles.png",
+    cache_dir: Path | None = cache_root / "atlas",
+) -> list[Surface]:
+    # one decode and one scale for the whole sheet; the tiles are subsurfaces
+    # of it, so they share its pixels. Scaled atlases are kept in cache_dir,
+    # keyed on the sheet's contents and the size, unless it is None
+    with open(path, "rb") as file_pointer:
+        source = file_pointer.read()
+    atlas = None
+    if cache_dir is not None:
+        key = hashlib.sha256(source).hexdigest()
+        target = cache_dir / f"{key}-{size}.png"
+        if target.exists():
+            try:
+                atlas = pygame.image.load(target)
+            except pygame.error:
+                # half-written; scale it again
+                pass
+    if atlas is None:
+        atlas = pygame.transform.scale(
+            pack_atlas(pygame.image.load(io.BytesIO(source), path)),
+            (atlas_columns * size, atlas_rows * size),
+        )
+        if cache_dir is not None:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            partial = target.with_name(f"{os.getpid()}-{target.name}")
+            pygame.image.save(atlas, partial)
+            os.replace(partial, target)
+    if pygame.display.get_surface() is not None:
+        atlas = atlas.convert()
+    return [
+        atlas.subsurface(Rect(x * size, y * size, size, size))
+        for y in range(atlas_rows)
+        for x in range(atlas_columns)
+    ]
+
+
+def pack_atlas(sheet: Surface) -> Surface:
+    # the sheet's tiles edge to edge in tile id order, without the grid lines,
+    # so scaling it scales every tile exactly as scaling each on its own would
+    pixels = pygame.surfarray.array3d(sheet)
+    offsets = np.arange(sheet_tile)
+    xs = ((np.arange(sheet_columns) * (sheet_tile + 1) + 1)[:, None] + offsets).ravel()
+    ys = ((np.arange(atlas_rows) * (sheet_tile + 1) + 1)[:, None] + offsets).ravel()
+    packed = np.zeros(
+        (atlas_columns * sheet_tile, atlas_rows * sheet_tile, 3), dtype=np.uint8
+    )
+    packed[: len(xs)] = pixels[np.ix_(xs, ys)]
+    return pygame.surfarray.make_surface(packed)
+
+
 def load_image(path: str, size: int = 30, remove_padding: int = 0) -> Surface:
     surface = pygame.image.load(path).convert_alpha()
     surface = pygame.transform.scale(
@@ -120,18 +188,180 @@ def render_tiles_by_solidity(
     render_message(display, "(space to continue)", 5, 380, font)
 
 
+@dataclass
+class MapSurfaces:
+    # the map pre-composited one screen at a time, so scrolling blits a few
+    # cached screens instead of every visible tile
+    tiles: list[Surface]
+    map_data: list[list[int]]
+    size: int = 30
+    screens: dict[tuple[int, int], Surface] = field(default_factory=dict)
+
+    def screen(self, chunkx: int, chunky: int) -> Surface:
+        surface = self.screens.get((chunkx, chunky))
+        if surface is None:
+            surface = Surface((screen_w * self.size, screen_h * self.size))
+            rows = self.map_data[chunky * screen_h : (chunky + 1) * screen_h]
+            surface.blits(
+                [
+                    (self.tiles[tile_id], (x * self.size, y * self.size))
+                    for y, row in enumerate(rows)
+                    for x, tile_id in enumerate(
+                        row[chunkx * screen_w : (chunkx + 1) * screen_w]
+                    )
+                ],
+                doreturn=False,
+            )
+            self.screens[(chunkx, chunky)] = surface
+        return surface
+
+    def draw(
+        self,
+        display: Surface,
+        from_x: int,
+        from_y: int,
+        columns: int = 20,
+        rows: int = 20,
+    ) -> None:
+        blit_screens(display, self.screen, from_x, from_y, columns, rows, self.size)
+
+
+def visible_screens(
+    from_x: int, from_y: int, columns: int, rows: int
+) -> list[tuple[int, int]]:
+    # (chunkx, chunky) of every screen a view from (from_x, from_y) overlaps
+    return [
+        (chunkx, chunky)
+        for chunky in range(from_y // screen_h, (from_y + rows - 1) // screen_h + 1)
+        for chunkx in range(from_x // screen_w, (from_x + columns - 1) // screen_w + 1)
+    ]
+
+
+def blit_screens(
+    display: Surface,
+    screen: Callable[[int, int], Surface],
+    from_x: int,
+    from_y: int,
+    columns: int,
+    rows: int,
+    size: int,
+) -> None:
+    # the parts of each screen in view, from screen(chunkx, chunky)
+    for chunkx, chunky in visible_screens(from_x, from_y, columns, rows):
+        left = max(from_x, chunkx * screen_w)
+        top = max(from_y, chunky * screen_h)
+        right = min(from_x + columns, (chunkx + 1) * screen_w)
+        bottom = min(from_y + rows, (chunky + 1) * screen_h)
+        display.blit(
+            screen(chunkx, chunky),
+            ((left - from_x) * size, (top - from_y) * size),
+            Rect(
+                (left - chunkx * screen_w) * size,
+                (top - chunky * screen_h) * size,
+                (right - left) * size,
+                (bottom - top) * size,
+            ),
+        )
+
+
+@dataclass
+class WorldSurfaces:
+    # like MapSurfaces, for a World that grows while it is shown: screens not
+    # generated yet are drawn as a placeholder, and only the most recently
+    # drawn max_screens composited screens are kept
+    tiles: list[Surface]
+    world: World
+    size: int = 30
+    max_screens: int = 64
+    screens: OrderedDict[tuple[int, int], Surface] = field(default_factory=OrderedDict)
+    placeholder: Surface = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.placeholder = Surface((screen_w * self.size, screen_h * self.size))
+        self.placeholder.fill((40, 40, 40))
+        for x in range(0, screen_w, 2):
+            for y in range(x // 2 % 2, screen_h, 2):
+                self.placeholder.fill(
+                    (60, 60, 60), Rect(x * self.size, y * self.size, *(self.size,) * 2)
+                )
+
+    def screen(self, chunkx: int, chunky: int) -> Surface:
+        surface = self.screens.get((chunkx, chunky))
+        if surface is not None:
+            self.screens.move_to_end((chunkx, chunky))
+            return surface
+        chunk = self.world.chunks.get((chunkx, chunky))
+        if chunk is None:
+            return self.placeholder
+        surface = Surface((screen_w * self.size, screen_h * self.size))
+        surface.blits(
+            [
+                (self.tiles[tile_id], (x * self.size, y * self.size))
+                for y, row in enumerate(chunk.tolist())
+                for x, tile_id in enumerate(row)
+            ],
+            doreturn=False,
+        )
+        self.screens[(chunkx, chunky)] = surface
+        while len(self.screens) > self.max_screens:
+            self.screens.popitem(last=False)
+        return surface
+
+    def draw(
+        self,
+        display: Surface,
+        from_x: int,
+        from_y: int,
+        columns: int = 20,
+        rows: int = 20,
+    ) -> None:
+        blit_screens(display, self.screen, from_x, from_y, columns, rows, self.size)
+
+
+def wanted_screens(
+    from_x: int,
+    from_y: int,
+    heading: tuple[int, int],
+    columns: int = 20,
+    rows: int = 20,
+) -> list[tuple[int, int]]:
+    # the screens in view, then the ones a screen further on in the direction
+    # of travel, nearest first
+    visible = visible_screens(from_x, from_y, columns, rows)
+    deltax, deltay = heading
+    ahead = visible_screens(
+        from_x + deltax * screen_w, from_y + deltay * screen_h, columns, rows
+    )
+    return visible + [each for each in ahead if each not in visible]
+
+
+def render_world(
+    surfaces: WorldSurfaces,
+    from_x: int,
+    from_y: int,
+    display: Surface,
+    font: Font,
+    generating: int,
+) -> None:
+    surfaces.draw(display, from_x, from_y)
+
+    pygame.draw.rect(display, (0, 0, 0), pygame.Rect(0, 0, 390, 70))
+
+    render_message(display, "Endless world: scroll anywhere!", 5, 5, font)
+
+    render_message(
+        display, f"({generating} screens generating, space to continue)", 5, 35, font
+    )
+
+
 def render_map_quadrant(
-    tiles: list[Surface],
-    map_data: list[list[int]],
+    surfaces: MapSurfaces,
     from_x: int,
     from_y: int,
     display: Surface,
     font: Font,
 ):
-    for y_offset, x_offset in itertools.product(range(20), range(20)):
-        tile_id = map_data[from_y + y_offset][from_x + x_offset]
-        tile = tiles[tile_id]
-        display.blit(tile, (x_offset * 30, y_offset * 30))
+    surfaces.draw(display, from_x, from_y)
 
     pygame.draw.rect(display, (0, 0, 0), pygame.Rect(0, 0, 390, 70))
 
@@ -140,6 +370,94 @@ def render_map_quadrant(
     render_message(display, "(space to continue)", 5, 35, font)
 
 
+@dataclass
+class CellView:
+    # draws a grid of tile ids (-1 for undecided) at origin, only touching
+    # the cells that changed since the last draw
+    tiles: list[Surface]
+    h: int
+    w: int
+    origin: tuple[int, int] = (0, 0)
+    size: int = 30
+    drawn: np.ndarray = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.forget()
+
+    def forget(self) -> None:
+        # e.g. after the display was cleared; the next draw repaints it all
+        self.drawn = np.full((self.h, self.w), -2, dtype=np.int64)
+
+    def draw(self, display: Surface, grid: np.ndarray) -> list[Rect]:
+        # the rects to hand to pygame.display.update
+        return self.paint(
+            display,
+            [
+                (x, y, int(grid[y, x]))
+                for y, x in np.argwhere(grid != self.drawn).tolist()
+            ],
+        )
+
+    def paint(
+        self, display: Surface, cells: Iterable[tuple[int, int, int]]
+    ) -> list[Rect]:
+        # like draw(), for just the given (x, y, tile id) cells
+        originx, originy = self.origin
+        dirty = []
+        for x, y, tile_id in cells:
+            if self.drawn[y, x] == tile_id:
+                continue
+            rect = Rect(
+                originx + x * self.size, originy + y * self.size, *(self.size,) * 2
+            )
+            if tile_id < 0:
+                display.fill((0, 0, 0), rect)
+            else:
+                display.blit(self.tiles[tile_id], rect)
+            self.drawn[y, x] = tile_id
+            dirty.append(rect)
+        return dirty
+
+
+def drain(
+    events: Iterator[SolveEvent], seconds: float
+) -> tuple[dict[tuple[int, int], int], bool, bool]:
+    # consume solver events for up to seconds; returns the latest tile id (-1
+    # while undecided) of each cell they changed, whether the solver restarted
+    # (so the whole wave needs drawing again), and whether it has finished
+    deadline = time.perf_counter() + seconds
+    changes: dict[tuple[int, int], int] = {}
+    restarted = False
+    for change in events:
+        if isinstance(change, Collapsed):
+            changes[(change.x, change.y)] = change.tile_id
+        elif isinstance(change, DomainChanged):
+            changes[(change.x, change.y)] = -1
+        elif isinstance(change, Restarted):
+            restarted = True
+            changes.clear()
+        if time.perf_counter() >= deadline:
+            return changes, restarted, False
+    return changes, restarted, True
+
+
+def render_generation(display: Surface, font: Font) -> None:
+    render_message(display, "Generating a new map (r for another one)", 5, 5, font)
+    render_message(
+        display, "(space to continue, i for stats, c for connected)", 5, 35, font
+    )
+
+
+def render_stats(display: Surface, stats: Stats | None, font: Font) -> Rect:
+    # solver counters and mean phase times over the message strip; returns the
+    # rect to update
+    strip = Rect(0, 0, display.get_width(), 60)
+    display.fill((0, 0, 0), strip)
+    for i, line in enumerate(stats.lines() if stats is not None else []):
+        render_message(display, line, 5, 5 + i * 30, font, 255, 255, 0)
+    return strip
+
+
 def render_message(
     display: Surface,
     text: str,
@@ -175,49 +493,155 @@ def main() -> None:
 
     scheduler = SimpleScheduler(driver := SleepDriver())
 
-    def go_up() -> None:
-        nonlocal y
-        y = max(y - 1, 0)
-
-    def go_down() -> None:
-        nonlocal y
-        y = min(y + 1, max_y)
-
-    def go_left() -> None:
-        nonlocal x
-        x = max(x - 1, 0)
-
-    def go_right() -> None:
-        nonlocal x
-        x = min(x + 1, max_x)
+    # the endless world starts at the east edge of the overworld, with the
+    # heading it was last scrolled in to prefetch along
+    endless_x = max_x
+    endless_y = 0
+    heading = (1, 0)
+
+    def move(deltax: int, deltay: int) -> None:
+        nonlocal x, y, endless_x, endless_y, heading
+        if mode == 5:
+            endless_x += deltax
+            endless_y += deltay
+            heading = (deltax, deltay)
+        else:
+            x = min(max(x + deltax, 0), max_x)
+            y = min(max(y + deltay, 0), max_y)
 
     def do_moves(steps: int, stopper: Cancellable) -> None:
         for pressed_key in keys:
-            movement[pressed_key]()
+            move(*movement[pressed_key])
 
     movement = {
-        pygame.K_UP: go_up,
-        pygame.K_DOWN: go_down,
-        pygame.K_LEFT: go_left,
-        pygame.K_RIGHT: go_right,
+        pygame.K_UP: (0, -1),
+        pygame.K_DOWN: (0, 1),
+        pygame.K_LEFT: (-1, 0),
+        pygame.K_RIGHT: (1, 0),
     }
 
     repeatedly(scheduler, do_moves, EverySecond(1 / 60))
 
-    while loop:
-        display.fill((0, 0, 0))
+    surfaces = MapSurfaces(tiles, overworld_map)
+    model = cached_model(prune=True)
+    # the rows below the message strip
+    view = CellView(tiles, 18, 20, origin=(0, 60))
+
+    # c toggles generating with every passable cell reachable from the others
+    connected = False
+
+    def generation() -> Solver:
+        connectivity = None
+        if connected:
+            connectivity = Connectivity.from_solidity(
+                model, TILE_SOLIDITY, everything=True
+            )
+        return Solver(
+            model,
+            view.h,
+            view.w,
+            Random(),
+            stats=Stats(),
+            connectivity=connectivity,
+        )
+
+    solver = generation()
+    generating = solver.events()
+    finished = False
+    show_stats = False
+    stats_shown = 0.0
+    world = World.from_map(model, overworld_map, seed=Random().randrange(2**32))
+    world_surfaces = WorldSurfaces(tiles, world)
+    # started the first time the endless world is shown; leaves a core to us
+    painter: Outpainter | None = None
+    cleanup = ExitStack()
+    arrived = 0
+    clock = pygame.time.Clock()
+    shown: tuple[int, ...] | None = None
 
-        if mode == 1:
-            render_tileset(display, tiles, font)
-        elif mode == 2:
-            render_tiles_by_solidity(display, tiles, TILE_SOLIDITY, font)
-        elif mode == 3:
-            render_map_quadrant(tiles, overworld_map, x, y, display, font)
+    while loop:
+        if mode == 5:
+            if painter is None:
+                painter = cleanup.enter_context(
+                    Outpainter(world, workers=max(1, (os.cpu_count() or 2) - 1))
+                )
+            in_view = visible_screens(endless_x, endless_y, 20, 20)
+            arrived += sum(chunk in in_view for chunk in painter.collect())
+            for chunk in wanted_screens(endless_x, endless_y, heading):
+                painter.request(chunk)
+
+        # only redraw the whole display when what it shows has changed
+        if mode == 3:
+            showing: tuple[int, ...] = (mode, x, y)
+        elif mode == 5 and painter is not None:
+            showing = (mode, endless_x, endless_y, arrived, len(painter.running))
+        else:
+            showing = (mode,)
+        if showing != shown:
+            display.fill((0, 0, 0))
+            if mode == 1:
+                render_tileset(display, tiles, font)
+            elif mode == 2:
+                render_tiles_by_solidity(display, tiles, TILE_SOLIDITY, font)
+            elif mode == 3:
+                render_map_quadrant(surfaces, x, y, display, font)
+            elif mode == 4:
+                if show_stats:
+                    render_stats(display, solver.stats, font)
+                else:
+                    render_generation(display, font)
+                view.forget()
+                view.draw(display, solver.wave.tiles())
+            elif mode == 5 and painter is not None:
+                render_world(
+                    world_surfaces,
+                    endless_x,
+                    endless_y,
+                    display,
+                    font,
+                    len(painter.running),
+                )
+            pygame.display.flip()
+            shown = showing
+
+        if mode == 4 and not finished:
+            # as many decisions as fit in a slice of the frame, then draw
+            # only the cells they changed
+            try:
+                changes, restarted, finished = drain(generating, 1 / 240)
+            except Contradiction:
+                solver = generation()
+                generating = solver.events()
+                changes, restarted = {}, True
+            started = time.perf_counter()
+            if restarted:
+                dirty = view.draw(display, solver.wave.tiles())
+            else:
+                dirty = view.paint(
+                    display, [(cx, cy, tile) for (cx, cy), tile in changes.items()]
+                )
+            if solver.stats is not None:
+                solver.stats.time("render", started)
+            # a few times a second is plenty for numbers to be read
+            if show_stats and (finished or started - stats_shown > 0.25):
+                dirty.append(render_stats(display, solver.stats, font))
+                stats_shown = started
+            pygame.display.update(dirty)
 
         for event in pygame.event.get():
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_SPACE:
-                    mode = 1 if mode == 3 else mode + 1
+                    mode = 1 if mode == 5 else mode + 1
+                if mode == 4 and event.key == pygame.K_c:
+                    connected = not connected
+                if mode == 4 and event.key in (pygame.K_SPACE, pygame.K_r, pygame.K_c):
+                    solver = generation()
+                    generating = solver.events()
+                    finished = False
+                    shown = None
+                if mode == 4 and event.key == pygame.K_i:
+                    show_stats = not show_stats
+                    shown = None
                 if event.key in movement:
                     keys.add(event.key)
                 if event.key in (pygame.K_q, pygame.K_ESCAPE):
@@ -230,8 +654,9 @@ def main() -> None:
             if event.type == pygame.QUIT:
                 loop = False
         driver.block(0)
-        pygame.display.flip()
+        clock.tick(60)
 
+    cleanup.close()
     print("Exiting...")
     exit()
 
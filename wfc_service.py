@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Coroutine
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from wfc_cache import ResultCache, result_key
+from wfc_model import CompiledSet, Contradiction
+from wfc_parallel import _attach, _attempt, share
+
+# largest map a single request may ask for
+max_cells = 1 << 20
+
+# wire format: "<HHc" height, width, numpy type code, then the ids row-major
+header = struct.Struct("<HHc")
+
+
+def encode(tiles: np.ndarray) -> bytes:
+    # the narrowest of uint8, uint16 or int16 (for -1s) that holds the ids
+    if tiles.size and tiles.min() < 0:
+        dtype = np.dtype("<i2")
+    elif tiles.size and tiles.max() > 255:
+        dtype = np.dtype("<u2")
+    else:
+        dtype = np.dtype("u1")
+    h, w = tiles.shape
+    return header.pack(h, w, dtype.char.encode()) + tiles.astype(dtype).tobytes()
+
+
+def decode(data: bytes) -> np.ndarray:
+    if len(data) < header.size:
+        raise ValueError("truncated tile array")
+    h, w, code = header.unpack_from(data)
+    if code not in (b"B", b"H", b"h"):
+        raise ValueError(f"unknown tile type {code!r}")
+    dtype = np.dtype(code.decode()).newbyteorder("<")
+    if len(data) != header.size + h * w * dtype.itemsize:
+        raise ValueError("tile array size does not match its header")
+    return np.frombuffer(data, dtype=dtype, offset=header.size).reshape(h, w)
+
+
+class NotFound(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Request:
+    h: int
+    w: int
+    seed: int
+    constraints: bytes | None = None
+    # encode()d (h, w) tile ids with -1 where free; kept as bytes so equal
+    # requests hash alike and can share one solve
+
+    def key(self, model: CompiledSet) -> str:
+        return result_key(model, self.h, self.w, self.seed, self.constraint_array())
+
+    def constraint_array(self) -> np.ndarray | None:
+        if self.constraints is None:
+            return None
+        constraints = decode(self.constraints).astype(np.int64)
+        if constraints.shape != (self.h, self.w):
+            raise ValueError("constraints do not match the requested size")
+        return constraints
+
+
+def _solve_batch(
+    batch: list[tuple[int, int, int, np.ndarray | None]],
+) -> list[np.ndarray | Exception | None]:
+    # one pool task for a whole batch, so small maps don't pay a round trip
+    # each; None wherever the solver gave up, and the exception wherever it
+    # failed, so that one bad request only fails itself
+    results: list[np.ndarray | Exception | None] = []
+    for h, w, seed, constraints in batch:
+        try:
+            results.append(_attempt(h, w, seed, constraints, {}))
+        except Exception as error:
+            results.append(error)
+    return results
+
+
+@dataclass
+class GenerationService:
+    model: CompiledSet
+    workers: int | None = None
+    batch_size: int = 16
+    batch_delay: float = 0.005
+    # how long the first request of a batch waits for company
+    results: ResultCache | None = None
+    # when set, maps already solved are answered from here
+    solves: int = 0
+    # requests actually sent to the pool, after coalescing and caching
+    running: dict[Request, asyncio.Future[np.ndarray]] = field(default_factory=dict)
+    queue: asyncio.Queue[tuple[Request, asyncio.Future[np.ndarray]]] = field(
+        default_factory=asyncio.Queue
+    )
+    tasks: set[asyncio.Task[None]] = field(default_factory=set)
+    pool: ProcessPoolExecutor | None = None
+    block: SharedMemory | None = None
+
+    async def __aenter__(self) -> GenerationService:
+        self.block, shared = share(self.model)
+        self.pool = ProcessPoolExecutor(
+            self.workers or os.cpu_count(),
+            # forked workers would inherit open client sockets and hold their
+            # connections open after the service is done with them
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_attach,
+            initargs=(shared,),
+        )
+        self.spawn(self.batches())
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        assert self.pool is not None and self.block is not None
+        self.pool.shutdown(cancel_futures=True)
+        self.block.close()
+        self.block.unlink()
+
+    def spawn(self, coroutine: Coroutine[Any, Any, None]) -> None:
+        # the loop only keeps weak references to tasks
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def generate(self, request: Request) -> np.ndarray:
+        # identical requests in flight at the same time share a single solve
+        future = self.running.get(request)
+        if future is None:
+            # raises ValueError here, rather than in a worker, if they're bad
+            constraints = request.constraint_array()
+            if constraints is not None:
+                unknown = set(np.unique(constraints[constraints >= 0]).tolist())
+                unknown -= self.model.index.keys()
+                if unknown:
+                    raise ValueError(f"tiles {sorted(unknown)} are not in the model")
+            if self.results is not None:
+                tiles = self.results.get(request.key(self.model))
+                if tiles is not None:
+                    return tiles
+            future = asyncio.get_running_loop().create_future()
+            self.running[request] = future
+            future.add_done_callback(lambda _: self.running.pop(request, None))
+            self.queue.put_nowait((request, future))
+        # one waiter going away must not cancel the solve for the others
+        return await asyncio.shield(future)
+
+    async def batches(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(
+                        await asyncio.wait_for(
+                            self.queue.get(), max(0, deadline - loop.time())
+                        )
+                    )
+                except TimeoutError:
+                    break
+            self.spawn(self.run(batch))
+
+    async def run(
+        self, batch: list[tuple[Request, asyncio.Future[np.ndarray]]]
+    ) -> None:
+        self.solves += len(batch)
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.pool,
+                _solve_batch,
+                [
+                    (request.h, request.w, request.seed, request.constraint_array())
+                    for request, _ in batch
+                ],
+            )
+        except Exception as error:
+            # e.g. the pool itself broke; nothing in the batch was solved
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (request, future), tiles in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(tiles, Exception):
+                future.set_exception(tiles)
+                continue
+            if tiles is None:
+                future.set_exception(Contradiction(request.h, request.w, request.seed))
+                continue
+            if self.results is not None:
+                tiles = self.results.put(request.key(self.model), tiles)
+            future.set_result(tiles)
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        # GET or POST /generate?h=..&w=..&seed=.., with encode()d constraints
+        # as the body if there are any; one request per connection
+        try:
+            try:
+                status, body = 200, await self.respond(reader)
+            except (ValueError, KeyError, asyncio.IncompleteReadError) as error:
+                status, body = 400, str(error).encode()
+            except NotFound:
+                status, body = 404, b"not found"
+            except Contradiction:
+                status, body = 422, b"could not generate that map"
+            reason = {200: "OK", 400: "Bad Request", 404: "Not Found"}.get(
+                status, "Unprocessable Entity"
+            )
+            content_type = "application/octet-stream" if status == 200 else "text/plain"
+            writer.write(
+                f"HTTP/1.1 {status} {reason}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1")
+                + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def respond(self, reader: asyncio.StreamReader) -> bytes:
+        method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        url = urlsplit(target)
+        if method not in ("GET", "POST") or url.path != "/generate":
+            raise NotFound(url.path)
+        query = parse_qs(url.query)
+        h, w = int(query["h"][0]), int(query["w"][0])
+        if not (0 < h < 1 << 16 and 0 < w < 1 << 16 and h * w <= max_cells):
+            raise ValueError(f"unsupported map size {w} x {h}")
+        seed = int(query.get("seed", ["0"])[0])
+        return encode(await self.generate(Request(h, w, seed, body or None)))
+
+
+async def serve(
+    model: CompiledSet, host: str = "127.0.0.1", port: int = 8765, **options: Any
+) -> None:
+    # options are passed on to GenerationService
+    async with GenerationService(model, **options) as service:
+        server = await asyncio.start_server(service.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+async def fetch(
+    host: str,
+    port: int,
+    h: int,
+    w: int,
+    seed: int = 0,
+    constraints: np.ndarray | None = None,
+) -> np.ndarray:
+    # a minimal client, e.g. for load testing serve()
+    body = b"" if constraints is None else encode(constraints)
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(
+            f"POST /generate?h={h}&w={w}&seed={seed} HTTP/1.1\r\n"
+            f"Host: {host}\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    if status != 200:
+        raise ValueError(f"{status}: {payload.decode(errors='replace')}")
+    return decode(payload)
+
+
+if __name__ == "__main__":
+    from wfc_cache import cached_model
+
+    asyncio.run(serve(cached_model()))